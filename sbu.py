@@ -15,18 +15,38 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
+import bz2
 import errno
 import filecmp
+import gzip
+import hashlib
+import heapq
+import io
+import json
 import logging
+import lzma
+import mmap
+import os
+import struct
+import tarfile
+import zlib
 from abc import ABC, abstractmethod
 from argparse import ArgumentParser, Namespace
+from bisect import bisect_right
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import datetime
 from enum import Enum, auto
+from fcntl import F_GETFL, F_SETFL, fcntl, ioctl
 from functools import reduce
 from pathlib import Path
-from shutil import copy2, copytree, make_archive
-from sys import exit, platform
-from tempfile import TemporaryDirectory
-from typing import Optional, cast
+from shutil import copyfileobj, copystat, copytree, rmtree
+from stat import S_ISDIR, S_ISREG
+from sys import argv, exit, platform
+from threading import Lock
+from time import mktime, perf_counter, time
+from typing import IO, Any, Callable, Iterable, Iterator, NamedTuple, Optional, cast
+from zipfile import ZIP_DEFLATED, ZIP_STORED, ZipFile, ZipInfo, is_zipfile
 
 
 class BackupFileParser:
@@ -75,6 +95,72 @@ class BackupFileParser:
             return None
 
 
+class StatCache:
+    # Errors which Path.exists() treats as "file does not exist".
+    _ignored_errors = (errno.ENOENT, errno.ENOTDIR, errno.EBADF, errno.ELOOP)
+
+    def __init__(self) -> None:
+        self._stats: dict[Path, Optional[os.stat_result]] = {}
+        self._resolved: dict[Path, Path] = {}
+        self._hits = 0
+        self._syscalls = 0
+
+    def stat(self, path: Path) -> Optional[os.stat_result]:
+        if path in self._stats:
+            self._hits += 1
+            return self._stats[path]
+
+        self._syscalls += 1
+        result: Optional[os.stat_result]
+        try:
+            result = path.stat()
+        except OSError as e:
+            if e.errno not in self._ignored_errors:
+                raise
+            result = None
+        self._stats[path] = result
+        return result
+
+    def resolve(self, path: Path) -> Path:
+        if path in self._resolved:
+            self._hits += 1
+            return self._resolved[path]
+
+        self._syscalls += 1
+        result = path.resolve()
+        self._resolved[path] = result
+        return result
+
+    def exists(self, path: Path) -> bool:
+        return self.stat(path) is not None
+
+    def is_file(self, path: Path) -> bool:
+        stat = self.stat(path)
+        return stat is not None and S_ISREG(stat.st_mode)
+
+    def is_dir(self, path: Path) -> bool:
+        stat = self.stat(path)
+        return stat is not None and S_ISDIR(stat.st_mode)
+
+    def identity(self, path: Path) -> Optional[tuple[int, int]]:
+        stat = self.stat(path)
+        return None if stat is None else (stat.st_dev, stat.st_ino)
+
+    def samefile(self, p1: Path, p2: Path) -> bool:
+        identity = self.identity(p1)
+        return identity is not None and identity == self.identity(p2)
+
+    def invalidate(self, path: Path) -> None:
+        self._stats.pop(path, None)
+        self._resolved.pop(path, None)
+
+    def log_statistics(self) -> None:
+        logging.debug(
+            f"Stat cache: {self._hits} hits, {self._syscalls} system calls, "
+            f"{len(self._stats)} paths cached"
+        )
+
+
 class FileFilter(ABC):
     @abstractmethod
     def filter(self, path: Path) -> bool:
@@ -91,8 +177,11 @@ class IsAbsolutePathFilter(FileFilter):
 
 
 class FileExistsFilter(FileFilter):
+    def __init__(self, stat_cache: StatCache) -> None:
+        self._stat_cache = stat_cache
+
     def filter(self, path: Path) -> bool:
-        if not path.exists():
+        if not self._stat_cache.exists(path):
             logging.warning(f"Path '{path}' does not exists. Is ignored.")
             return False
         else:
@@ -100,11 +189,12 @@ class FileExistsFilter(FileFilter):
 
 
 class PathNotDestFolderFilter(FileFilter):
-    def __init__(self, dest: Path) -> None:
+    def __init__(self, dest: Path, stat_cache: StatCache) -> None:
         self._dest = dest
+        self._stat_cache = stat_cache
 
     def filter(self, path: Path) -> bool:
-        if self._dest.samefile(path):
+        if self._stat_cache.samefile(self._dest, path):
             logging.warning(
                 f"Path '{path}' should be backed up and is the backup folder.  Is ignored."
             )
@@ -138,23 +228,30 @@ class DestFolderNotIncludedInPathFilter(FileFilter):
 
 
 class Filterer:
-    def __init__(self, dest: Path, files: list[Path]) -> None:
-        if not dest.exists():
+    def __init__(
+        self,
+        dest: Path,
+        files: list[Path],
+        *,
+        stat_cache: Optional[StatCache] = None,
+    ) -> None:
+        stat_cache = stat_cache if stat_cache is not None else StatCache()
+        if not stat_cache.exists(dest):
             raise FileNotFoundError(
                 f"The destination directory '{dest}' does not exist"
             )
-        if not dest.is_dir():
+        if not stat_cache.is_dir(dest):
             raise NotADirectoryError(
                 f"The destination path '{dest}' does not refer to a directory"
             )
-        self._dest = dest.resolve()
+        self._dest = stat_cache.resolve(dest)
         self._files = files
 
         filters: list[FileFilter] = []
         filters.append(IsAbsolutePathFilter())
-        filters.append(FileExistsFilter())
+        filters.append(FileExistsFilter(stat_cache))
         filters.append(DestFolderNotIncludedInPathFilter(self._dest))
-        filters.append(PathNotDestFolderFilter(self._dest))
+        filters.append(PathNotDestFolderFilter(self._dest, stat_cache))
         filters.append(PathNotIncludedInDestFolderFilter(self._dest))
         self._filters = filters
 
@@ -175,8 +272,11 @@ class Filterer:
 
 
 class Optimizer:
-    def __init__(self, files: list[Path]) -> None:
+    def __init__(
+        self, files: list[Path], *, stat_cache: Optional[StatCache] = None
+    ) -> None:
         self._files = files
+        self._stat_cache = stat_cache if stat_cache is not None else StatCache()
 
     # Given a list S of paths to files or folder to copy.
     # How to find the minimal subset S' of S such that copying all files and
@@ -192,10 +292,12 @@ class Optimizer:
     # Then <= is a partial order.
     # Moreover, S' then is the set of maximal elements of S using <=.
     #
-    # To find the maximal elements in the worst case O(n^2) time is required:
-    # Consider a set where no two elements are comparable (so every element is
-    # maximal). To determine that no two elements are comparable each element
-    # need to be compare to each other.
+    # Comparing every element to every other element takes O(n^2) time.  But
+    # the partial order is induced by a tree (the file system hierarchy), so
+    # we can do better: Sort the paths lexicographically by their components.
+    # Then all descendants of a path p directly follow p in the sorted list.
+    # So a single sweep which remembers the last maximal element suffices to
+    # find all maximal elements in O(n log n) comparisons of path components.
     def _minimize_paths(self, paths: list[Path]) -> set[Path]:
         logging.info("Minimizing paths to copy")
 
@@ -204,26 +306,879 @@ class Optimizer:
         # but Path("/a/b/../") != (Path("/a/")).
         # So use path.resolve() to obtain canonical representation and then
         # eliminate the duplicates.
-        paths = list(set(path.resolve() for path in paths))
-        has_successor = [False] * len(paths)
+        resolved = sorted(
+            map(self._stat_cache.resolve, set(paths)), key=lambda path: path.parts
+        )
+
+        result: set[Path] = set()
+        maximal: tuple[str, ...] = ()
+        for path in resolved:
+            parts = path.parts
+            if maximal and parts[: len(maximal)] == maximal:
+                continue
+            maximal = parts
+            result.add(path)
 
-        for i, p1 in enumerate(paths):
-            for j, p2 in enumerate(paths):
-                if j <= i:
-                    continue
-                elif p1.samefile(p2):
-                    assert False, "Resolved path representations are unique"
-                elif p1 in p2.parents:
-                    has_successor[j] = True
-                elif p2 in p1.parents:
-                    has_successor[i] = True
-
-        result = {path for i, path in enumerate(paths) if not has_successor[i]}
         logging.debug(f"Paths left after minimizing: {result}")
         return result
 
+    # Resolving paths does not detect every alias: Hardlinks and bind mounts
+    # make the same file (or folder) reachable through different canonical
+    # paths.  Such aliases are identified by their device and inode number.
+    # A path is an alias if either another path has the same identity, or one
+    # of its parents has the same identity as a folder that is copied anyway.
+    def _remove_aliases(self, paths: set[Path]) -> set[Path]:
+        logging.info("Removing aliases of paths to copy")
+        identity = self._stat_cache.identity
+        originals: dict[tuple[int, int], Path] = {}
+        candidates: list[Path] = []
+        for path in sorted(paths, key=lambda path: path.parts):
+            key = identity(path)
+            if key is None:
+                candidates.append(path)
+            elif key in originals:
+                logging.warning(
+                    f"Path '{path}' is the same file as '{originals[key]}'. Is ignored."
+                )
+            else:
+                originals[key] = path
+                candidates.append(path)
+
+        folders = {
+            key: path
+            for key, path in originals.items()
+            if self._stat_cache.is_dir(path)
+        }
+        result: set[Path] = set()
+        for path in candidates:
+            original = next(
+                (
+                    folders[key]
+                    for key in map(identity, path.parents)
+                    if key is not None and key in folders
+                ),
+                None,
+            )
+            if original is not None:
+                logging.warning(
+                    f"Path '{path}' is part of '{original}' through an alias. Is ignored."
+                )
+            else:
+                result.add(path)
+
+        logging.debug(f"Paths left after removing aliases: {result}")
+        return result
+
     def optimize(self) -> set[Path]:
-        return self._minimize_paths(self._files)
+        return self._remove_aliases(self._minimize_paths(self._files))
+
+
+class ReflinkMode(Enum):
+    AUTO = "auto"
+    ALWAYS = "always"
+    NEVER = "never"
+
+    @classmethod
+    def values(cls) -> list[str]:
+        return ["auto", "always", "never"]
+
+
+class CachePolicy(Enum):
+    KEEP = "keep"
+    DROP = "drop"
+
+    @classmethod
+    def values(cls) -> list[str]:
+        return ["keep", "drop"]
+
+
+class FileCopier:
+    class Backend(Enum):
+        REFLINK = "reflink"
+        COPY_FILE_RANGE = "copy_file_range"
+        SENDFILE = "sendfile"
+        USERSPACE = "userspace"
+        DELTA = "delta"
+        RANGES = "parallel ranges"
+        DIRECT = "direct I/O"
+
+    # Maximum number of bytes passed to a single system call.
+    _chunk_size = 1 << 30
+    _userspace_chunk_size = 1 << 20
+    _delta_block_size = 1 << 17
+    _range_size = 1 << 26
+
+    # ioctl request number to clone a file (_IOW(0x94, 9, int) in linux/fs.h).
+    _ficlone = 0x40049409
+
+    # Errors which indicate that a system call cannot be used for a specific
+    # pair of files, e.g. because they are on different file systems or the
+    # file system does not support it.
+    _fallback_errors = (
+        errno.EXDEV,
+        errno.ENOSYS,
+        errno.EINVAL,
+        errno.EOPNOTSUPP,
+        errno.EBADF,
+        errno.ENOTSOCK,
+        errno.ENOTTY,
+    )
+
+    # Existing targets of at least delta_threshold bytes are updated in place
+    # by only rewriting the blocks which differ from the source.  Files of at
+    # least split_threshold bytes are split into ranges which are copied
+    # concurrently by split_threads threads.
+    # With the cache policy "drop" the page cache is told that files are read
+    # sequentially and to drop their pages once copied, so a backup does not
+    # evict the data other programs work with.  Files of at least
+    # direct_threshold bytes bypass the page cache completely (O_DIRECT).
+    def __init__(
+        self,
+        *,
+        reflink: ReflinkMode = ReflinkMode.AUTO,
+        delta_threshold: Optional[int] = None,
+        split_threshold: Optional[int] = None,
+        split_threads: int = 1,
+        cache: CachePolicy = CachePolicy.KEEP,
+        direct_threshold: Optional[int] = None,
+    ) -> None:
+        self._reflink = reflink
+        self._drop_cache = cache == CachePolicy.DROP and hasattr(os, "posix_fadvise")
+        self._direct_threshold = direct_threshold if hasattr(os, "O_DIRECT") else None
+        self._delta_threshold = delta_threshold
+        self._split_threshold = split_threshold
+        self._range_executor: Optional[ThreadPoolExecutor] = None
+        if split_threshold is not None and split_threads > 1:
+            self._range_executor = ThreadPoolExecutor(max_workers=split_threads)
+        self._lock = Lock()
+        self._statistics: dict[FileCopier.Backend, tuple[int, int, float]] = {}
+        self._delta_written = 0
+        self._has_copy_file_range = hasattr(os, "copy_file_range")
+        self._has_sendfile = hasattr(os, "sendfile")
+
+    # Copies the file contents and metadata like shutil.copy2(), but lets the
+    # kernel copy the data if possible, so it never passes through user space.
+    # The copy is written to a temporary file next to the target, which
+    # replaces the target when complete, so the target is never left half
+    # written (delta copies are the exception, they update the target in
+    # place).  Can be used as copy_function for shutil.copytree().
+    # Returns the metadata of the source at the time it was copied.
+    def copy(self, src: Path | str, target: Path | str) -> os.stat_result:
+        start = perf_counter()
+        with open(src, "rb") as fsrc:
+            stat = os.fstat(fsrc.fileno())
+            if self._drop_cache:
+                os.posix_fadvise(fsrc.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+            if self._use_delta(stat, target):
+                with open(target, "r+b") as fdst:
+                    backend, size = self._copy_delta(fsrc, fdst)
+                    self._drop(fsrc, fdst)
+                copystat(src, target)
+            else:
+                temporary = self.temporary_path(Path(target))
+                try:
+                    with open(temporary, "wb") as fdst:
+                        if self._use_ranges(stat):
+                            backend, size = self._copy_ranges(fsrc, fdst)
+                        elif self._use_direct(stat):
+                            backend, size = self._copy_direct(fsrc, fdst)
+                        else:
+                            backend, size = self._copy_data(fsrc, fdst)
+                        self._drop(fsrc, fdst)
+                    copystat(src, temporary)
+                    os.replace(temporary, target)
+                except BaseException:
+                    temporary.unlink(missing_ok=True)
+                    raise
+        self._record(backend, size, perf_counter() - start)
+        return stat
+
+    # Whether an error means that a system call (or ioctl) is not supported
+    # for the given files, so the caller should fall back to another way.
+    @classmethod
+    def is_fallback_error(cls, error: OSError) -> bool:
+        return error.errno in cls._fallback_errors
+
+    # The temporary file is named after a hash of the full target name, so
+    # it is short enough for any file system and unique within the folder.
+    # Being the same in every run, it is the name recorded in the journal.
+    @staticmethod
+    def temporary_path(target: Path) -> Path:
+        digest = hashlib.sha256(os.fsencode(target.name)).hexdigest()[:32]
+        return target.with_name(f".{digest}.sbu-tmp")
+
+    def close(self) -> None:
+        if self._range_executor is not None:
+            self._range_executor.shutdown(wait=True, cancel_futures=True)
+            self._range_executor = None
+
+    # Dirty pages cannot be dropped, so the target is written to disk first.
+    # The source pages are dropped even if they were cached before the copy,
+    # as there is no (portable) way to tell.
+    def _drop(self, fsrc: Any, fdst: Any) -> None:
+        if not self._drop_cache:
+            return
+        fdst.flush()
+        os.fdatasync(fdst.fileno())
+        os.posix_fadvise(fdst.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+        os.posix_fadvise(fsrc.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+
+    def _use_direct(self, stat: os.stat_result) -> bool:
+        return (
+            self._direct_threshold is not None
+            and stat.st_size >= self._direct_threshold
+        )
+
+    # Copies the data with O_DIRECT, so it never enters the page cache.  Direct
+    # I/O needs buffers, offsets and lengths aligned to the block size of the
+    # file system, so the data is copied using a page aligned buffer (a memory
+    # map) and the last partial block is written without O_DIRECT.  Cloning is
+    # still preferred, since it does not need to read anything.  Falls back to
+    # a normal copy, if the file system does not support O_DIRECT.
+    def _copy_direct(self, fsrc: Any, fdst: Any) -> tuple[Backend, int]:
+        infd, outfd = fsrc.fileno(), fdst.fileno()
+        if self._reflink != ReflinkMode.NEVER and self._clone(infd, outfd):
+            return FileCopier.Backend.REFLINK, os.fstat(infd).st_size
+        try:
+            for fd in (infd, outfd):
+                fcntl(fd, F_SETFL, fcntl(fd, F_GETFL) | os.O_DIRECT)
+        except OSError as e:
+            if not self.is_fallback_error(e):
+                raise
+            logging.debug(f"O_DIRECT is not supported, copying normally ({e})")
+            self._direct_threshold = None
+            for fd in (infd, outfd):
+                fcntl(fd, F_SETFL, fcntl(fd, F_GETFL) & ~os.O_DIRECT)
+            return self._copy_data(fsrc, fdst)
+
+        offset = 0
+        direct = True
+        with mmap.mmap(-1, self._userspace_chunk_size) as buffer:
+            while size := os.preadv(infd, [buffer], offset):
+                # A short read (at the end of the file, or on network file
+                # systems anywhere) leaves the following offsets unaligned.
+                if direct and size % mmap.PAGESIZE != 0:
+                    for fd in (infd, outfd):
+                        fcntl(fd, F_SETFL, fcntl(fd, F_GETFL) & ~os.O_DIRECT)
+                    direct = False
+                with memoryview(buffer) as view:
+                    position = offset
+                    data = view[:size]
+                    while data:
+                        written = os.pwritev(outfd, [data], position)
+                        data = data[written:]
+                        position += written
+                    data.release()
+                offset += size
+        if offset != os.fstat(infd).st_size:
+            raise OSError(errno.EIO, "Source file changed size while copying it")
+        return FileCopier.Backend.DIRECT, offset
+
+    def _use_ranges(self, stat: os.stat_result) -> bool:
+        return (
+            self._range_executor is not None
+            and self._split_threshold is not None
+            and stat.st_size >= self._split_threshold
+        )
+
+    # A single stream rarely saturates a RAID or NVMe drive, so large files are
+    # copied in ranges by several threads at once.  Positional reads and
+    # writes (or copy_file_range() with explicit offsets) do not share a file
+    # position, so the threads can use the same file descriptors.
+    def _copy_ranges(self, fsrc: Any, fdst: Any) -> tuple[Backend, int]:
+        assert self._range_executor is not None
+        infd, outfd = fsrc.fileno(), fdst.fileno()
+        if self._reflink != ReflinkMode.NEVER and self._clone(infd, outfd):
+            return FileCopier.Backend.REFLINK, os.fstat(infd).st_size
+
+        size = os.fstat(infd).st_size
+        os.ftruncate(outfd, size)
+        futures = [
+            self._range_executor.submit(
+                self._copy_range,
+                infd,
+                outfd,
+                start,
+                min(start + self._range_size, size),
+            )
+            for start in range(0, size, self._range_size)
+        ]
+        for future in futures:
+            future.result()
+        return FileCopier.Backend.RANGES, size
+
+    def _copy_range(self, infd: int, outfd: int, start: int, end: int) -> None:
+        kernel_copy = self._has_copy_file_range
+        offset = start
+        while offset < end:
+            length = min(end - offset, self._userspace_chunk_size)
+            if kernel_copy:
+                try:
+                    copied = os.copy_file_range(
+                        infd, outfd, end - offset, offset_src=offset, offset_dst=offset
+                    )
+                except OSError as e:
+                    if not self.is_fallback_error(e):
+                        raise
+                    kernel_copy = False
+                    continue
+            else:
+                copied = os.pwrite(outfd, os.pread(infd, length, offset), offset)
+            if copied == 0:
+                raise OSError(errno.EIO, "Source file shrank while copying it")
+            offset += copied
+
+    def _copy_data(self, fsrc: Any, fdst: Any) -> tuple[Backend, int]:
+        infd, outfd = fsrc.fileno(), fdst.fileno()
+        if self._reflink != ReflinkMode.NEVER and self._clone(infd, outfd):
+            return FileCopier.Backend.REFLINK, os.fstat(infd).st_size
+        if self._has_copy_file_range:
+            size = self._kernel_copy(self._copy_file_range, infd, outfd)
+            if size is not None:
+                return FileCopier.Backend.COPY_FILE_RANGE, size
+        if self._has_sendfile:
+            size = self._kernel_copy(self._sendfile, infd, outfd)
+            if size is not None:
+                return FileCopier.Backend.SENDFILE, size
+
+        copyfileobj(fsrc, fdst, self._userspace_chunk_size)
+        return FileCopier.Backend.USERSPACE, fdst.tell()
+
+    def _use_delta(self, stat: os.stat_result, target: Path | str) -> bool:
+        if self._delta_threshold is None or stat.st_size < self._delta_threshold:
+            return False
+        try:
+            return S_ISREG(os.stat(target).st_mode)
+        except FileNotFoundError:
+            return False
+
+    # Reads source and target block by block and only writes the blocks of
+    # the source which differ from the target.  Cloning is still preferred,
+    # since it does not need to read anything.
+    def _copy_delta(self, fsrc: Any, fdst: Any) -> tuple[Backend, int]:
+        infd, outfd = fsrc.fileno(), fdst.fileno()
+        if self._reflink != ReflinkMode.NEVER and self._clone(infd, outfd):
+            return FileCopier.Backend.REFLINK, os.fstat(infd).st_size
+
+        offset = 0
+        written = 0
+        while block := os.pread(infd, self._delta_block_size, offset):
+            if os.pread(outfd, len(block), offset) != block:
+                position = offset
+                view = memoryview(block)
+                while view:
+                    size = os.pwrite(outfd, view, position)
+                    view = view[size:]
+                    position += size
+                written += len(block)
+            offset += len(block)
+        os.ftruncate(outfd, offset)
+        with self._lock:
+            self._delta_written += written
+        return FileCopier.Backend.DELTA, offset
+
+    # On copy-on-write file systems (e.g. Btrfs or XFS) a file can be cloned
+    # instead of copied: Source and target share their data blocks until one
+    # of them is modified, so even huge files are "copied" instantly.
+    def _clone(self, infd: int, outfd: int) -> bool:
+        try:
+            ioctl(outfd, self._ficlone, infd)
+            return True
+        except OSError as e:
+            if self._reflink == ReflinkMode.ALWAYS:
+                raise OSError(e.errno, f"Cannot clone file: {e.strerror}") from e
+            if not self.is_fallback_error(e):
+                raise
+            return False
+
+    # Returns the number of bytes copied or None if the system call cannot be
+    # used.  Falling back is only possible if nothing was copied yet.
+    def _kernel_copy(self, call: Any, infd: int, outfd: int) -> Optional[int]:
+        offset = 0
+        while True:
+            try:
+                copied = call(infd, outfd, offset)
+            except OSError as e:
+                if offset == 0 and self.is_fallback_error(e):
+                    if e.errno == errno.ENOSYS:
+                        self._disable(call)
+                    return None
+                raise
+            if copied == 0:
+                break
+            offset += copied
+
+        # Some file systems (e.g. procfs) report no data for files which are
+        # not actually empty, so let the next backend retry empty files.
+        return offset if offset > 0 else None
+
+    def _copy_file_range(self, infd: int, outfd: int, offset: int) -> int:
+        return os.copy_file_range(
+            infd, outfd, self._chunk_size, offset_src=offset, offset_dst=offset
+        )
+
+    def _sendfile(self, infd: int, outfd: int, offset: int) -> int:
+        return os.sendfile(outfd, infd, offset, self._chunk_size)
+
+    def _disable(self, call: Any) -> None:
+        if call == self._copy_file_range:
+            self._has_copy_file_range = False
+        elif call == self._sendfile:
+            self._has_sendfile = False
+
+    def _record(self, backend: Backend, size: int, seconds: float) -> None:
+        with self._lock:
+            files, total, time = self._statistics.get(backend, (0, 0, 0.0))
+            self._statistics[backend] = (files + 1, total + size, time + seconds)
+
+    def log_statistics(self) -> None:
+        for backend, (files, size, seconds) in self._statistics.items():
+            throughput = size / seconds if seconds > 0 else 0.0
+            logging.info(
+                f"Copied {files} files ({Util.format_size(size)}) using "
+                f"{backend.value} in {seconds:.2f}s "
+                f"({Util.format_size(throughput)}/s)"
+            )
+            if backend == FileCopier.Backend.DELTA:
+                logging.info(
+                    f"Wrote {Util.format_size(self._delta_written)} of "
+                    f"{Util.format_size(size)} "
+                    f"({100 * self._delta_written / max(size, 1):.1f}%) "
+                    "using delta copies"
+                )
+
+
+class TraversalOrder(Enum):
+    DIRECTORY = "directory"
+    INODE = "inode"
+    EXTENT = "extent"
+
+    @classmethod
+    def values(cls) -> list[str]:
+        return ["directory", "inode", "extent"]
+
+
+class DirectoryReader:
+    # ioctl request number to map the extents of a file
+    # (_IOWR('f', 11, struct fiemap) in linux/fs.h).
+    _fiemap = 0xC020660B
+    # struct fiemap followed by a single struct fiemap_extent.
+    _fiemap_header = struct.Struct("=QQLLLL")
+    _fiemap_extent = struct.Struct("=QQQQQLLLL")
+
+    # Reads the entries of a folder in the given order:
+    # - directory: In the order stored in the folder (like os.scandir()).
+    # - inode:     By inode number, which is known from reading the folder.
+    #              On most file systems inodes (and often the data of small
+    #              files) are allocated in ascending order, so reading files
+    #              in this order reduces seeking on rotational disks a lot.
+    # - extent:    By the physical location of the first block of every file
+    #              on disk (using the FIEMAP ioctl), which needs to open every
+    #              file.  Falls back to inode order, if the file system does
+    #              not support FIEMAP.
+    def __init__(self, *, order: TraversalOrder = TraversalOrder.DIRECTORY) -> None:
+        self._order = order
+        self._has_fiemap = True
+
+    def read(self, folder: Path | str) -> list[os.DirEntry[str]]:
+        with os.scandir(folder) as it:
+            entries = list(it)
+        if self._order == TraversalOrder.INODE:
+            entries.sort(key=lambda entry: entry.inode())
+        elif self._order == TraversalOrder.EXTENT:
+            entries.sort(key=lambda entry: (self._first_extent(entry), entry.inode()))
+        return entries
+
+    # Returns the physical offset of the first extent of a file, or 0 if it
+    # is unknown (e.g. for folders and empty files).
+    def _first_extent(self, entry: os.DirEntry[str]) -> int:
+        if not self._has_fiemap or not entry.is_file():
+            return 0
+        request = bytearray(
+            self._fiemap_header.pack(0, 0xFFFFFFFFFFFFFFFF, 0, 0, 1, 0)
+            + bytes(self._fiemap_extent.size)
+        )
+        try:
+            fd = os.open(entry.path, os.O_RDONLY)
+            try:
+                ioctl(fd, self._fiemap, request)
+            finally:
+                os.close(fd)
+        except OSError as e:
+            if FileCopier.is_fallback_error(e):
+                logging.debug(f"FIEMAP is not supported, sorting by inode ({e})")
+                self._has_fiemap = False
+                return 0
+            raise
+        mapped_extents = self._fiemap_header.unpack_from(request)[3]
+        if mapped_extents == 0:
+            return 0
+        return int(
+            self._fiemap_extent.unpack_from(request, self._fiemap_header.size)[1]
+        )
+
+
+class ComparisonMode(Enum):
+    SIZE_MTIME = "size+mtime"
+    SHALLOW = "shallow"
+    FULL_CONTENT = "full-content"
+    HASH = "hash"
+
+    @classmethod
+    def values(cls) -> list[str]:
+        return ["size+mtime", "shallow", "full-content", "hash"]
+
+
+class Manifest:
+    _file_name = ".sbu-manifest"
+    _version = 1
+
+    class Entry(NamedTuple):
+        size: int
+        mtime_ns: int
+        inode: int
+        digest: Optional[str]
+
+    # The manifest records the metadata of every source file which has been
+    # backed up by the last successful run.  If the metadata of a source file
+    # is still the same, then the file has not changed since and neither the
+    # file nor its copy in the backup folder need to be looked at again.
+    def __init__(self, dest: Path) -> None:
+        self._path = dest.joinpath(self._file_name)
+        self._previous: dict[str, Manifest.Entry] = {}
+        self._current: dict[str, Manifest.Entry] = {}
+        self._lock = Lock()
+
+    def load(self) -> None:
+        if not self._path.exists():
+            logging.debug(f"No manifest found at '{self._path}'")
+            return
+
+        logging.info(f"Reading manifest '{self._path}'")
+        try:
+            with open(self._path) as lines:
+                header = json.loads(next(lines, "{}"))
+                if header.get("version") != self._version:
+                    raise ValueError(f"Unknown version {header.get('version')}")
+                for line in lines:
+                    entry = json.loads(line)
+                    self._previous[entry["path"]] = Manifest.Entry(
+                        entry["size"],
+                        entry["mtime_ns"],
+                        entry["inode"],
+                        entry.get("digest"),
+                    )
+        except (ValueError, KeyError, TypeError, AttributeError) as e:
+            logging.warning(f"Manifest '{self._path}' is invalid ({e}). Is ignored.")
+            self._previous = {}
+        logging.debug(f"Manifest contains {len(self._previous)} files")
+
+    def unchanged(self, path: Path, stat: Optional[os.stat_result]) -> bool:
+        entry = self._previous.get(str(path))
+        if entry is None or stat is None:
+            return False
+        elif (entry.size, entry.mtime_ns, entry.inode) != (
+            stat.st_size,
+            stat.st_mtime_ns,
+            stat.st_ino,
+        ):
+            return False
+
+        with self._lock:
+            self._current[str(path)] = entry
+        return True
+
+    # Returns the checksum of the file's contents at the time of the last run.
+    def digest(self, path: Path) -> Optional[str]:
+        entry = self._previous.get(str(path))
+        return None if entry is None else entry.digest
+
+    def add(
+        self, path: Path, stat: os.stat_result, digest: Optional[str] = None
+    ) -> None:
+        entry = Manifest.Entry(stat.st_size, stat.st_mtime_ns, stat.st_ino, digest)
+        with self._lock:
+            self._current[str(path)] = entry
+
+    def save(self) -> None:
+        logging.info(f"Writing manifest '{self._path}'")
+        tmp = self._path.with_name(self._path.name + ".tmp")
+        with open(tmp, "w") as f:
+            f.write(json.dumps({"version": self._version}) + "\n")
+            for path, entry in self._current.items():
+                f.write(json.dumps({"path": path, **entry._asdict()}) + "\n")
+        os.replace(tmp, self._path)
+        logging.debug(f"Manifest contains {len(self._current)} files")
+
+
+class Journal:
+    _file_name = ".sbu-journal"
+    # Number of finished files after which the copies and the journal are
+    # written to disk.
+    _sync_interval = 64
+
+    # The journal is written while copying files to a backup folder: Before a
+    # file is copied to a temporary file the temporary file is recorded, after
+    # it has been renamed to the target the metadata of the source is
+    # recorded.  It is removed after a successful run.  If a run is
+    # interrupted, the next run removes the temporary files of the copies
+    # which were in flight and skips files which were done and have not
+    # changed since (and whose copy still has the right size), without
+    # comparing them again.
+    def __init__(self, dest: Path) -> None:
+        self._path = dest.joinpath(self._file_name)
+        self._done: dict[str, tuple[int, int, int]] = {}
+        self._file: Optional[IO[str]] = None
+        self._lock = Lock()
+        self._finished: list[dict[str, Any]] = []
+
+    def open(self) -> None:
+        if self._path.exists():
+            self._resume()
+        self._file = open(self._path, "a")
+
+    def _resume(self) -> None:
+        logging.info(f"Resuming interrupted run using journal '{self._path}'")
+        in_flight: set[str] = set()
+        with open(self._path) as lines:
+            for line in lines:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # The last line may be incomplete.
+                    break
+                if "started" in entry:
+                    in_flight.add(entry["started"])
+                else:
+                    in_flight.discard(entry["temporary"])
+                    self._done[entry["path"]] = (
+                        entry["size"],
+                        entry["mtime_ns"],
+                        entry["inode"],
+                    )
+        for temporary in in_flight:
+            logging.debug(f"Removing incomplete copy '{temporary}'")
+            Path(temporary).unlink(missing_ok=True)
+        logging.debug(f"Journal contains {len(self._done)} finished files")
+
+    def done(
+        self,
+        path: Path,
+        stat: Optional[os.stat_result],
+        target: Optional[os.stat_result],
+    ) -> bool:
+        entry = self._done.get(str(path))
+        return (
+            entry is not None
+            and stat is not None
+            and entry == (stat.st_size, stat.st_mtime_ns, stat.st_ino)
+            and target is not None
+            and S_ISREG(target.st_mode)
+            and target.st_size == stat.st_size
+        )
+
+    # Written right away, so the temporary file is removed by the next run
+    # even if this one is killed.
+    def start(self, temporary: Path) -> None:
+        with self._lock:
+            self._write({"started": str(temporary)})
+
+    # Finished files are only written to the journal after their copies have
+    # been written to disk, every _sync_interval files.  So an entry never
+    # reaches the disk before the copy it refers to (e.g. when the drive is
+    # unplugged), while copies are not synced one by one.
+    def finish(self, path: Path, stat: os.stat_result, temporary: Path) -> None:
+        with self._lock:
+            self._finished.append(
+                {
+                    "path": str(path),
+                    "size": stat.st_size,
+                    "mtime_ns": stat.st_mtime_ns,
+                    "inode": stat.st_ino,
+                    "temporary": str(temporary),
+                }
+            )
+            if len(self._finished) >= self._sync_interval:
+                self._sync()
+
+    # Must be called holding the lock.  Python has no syncfs(), so all file
+    # systems are synced.
+    def _sync(self) -> None:
+        assert self._file is not None
+        os.sync()
+        for entry in self._finished:
+            self._write(entry)
+        self._finished = []
+        os.fsync(self._file.fileno())
+
+    # Every entry is handed to the operating system right away, so it
+    # survives the process being killed.
+    def _write(self, entry: dict[str, Any]) -> None:
+        assert self._file is not None
+        self._file.write(json.dumps(entry) + "\n")
+        self._file.flush()
+
+    def close(self, *, complete: bool) -> None:
+        if self._file is not None:
+            with self._lock:
+                self._sync()
+            self._file.close()
+            self._file = None
+        if complete:
+            self._path.unlink(missing_ok=True)
+
+
+class FileComparer:
+    _hash_algorithm = "sha256"
+
+    def __init__(
+        self,
+        *,
+        mode: ComparisonMode = ComparisonMode.SHALLOW,
+        stat_cache: Optional[StatCache] = None,
+        manifest: Optional[Manifest] = None,
+    ) -> None:
+        self._mode = mode
+        self._stat_cache = stat_cache if stat_cache is not None else StatCache()
+        self._manifest = manifest
+        self._digests: dict[Path, str] = {}
+
+    # Decides whether the target is an identical copy of the source:
+    # - size+mtime: Only compares size and modification time, never reads any
+    #               file.  Since copies keep the modification time of their
+    #               source this is enough to detect unchanged files.
+    # - shallow:    Like filecmp.cmp(): Files with the same type, size and
+    #               modification time are identical, otherwise the contents
+    #               are compared.
+    # - full-content: Always compares the contents.
+    # - hash:       Compares checksums of the contents.
+    def identical(self, src: Path, target: Path) -> bool:
+        if self._mode == ComparisonMode.SHALLOW:
+            return filecmp.cmp(src, target, shallow=True)
+        elif self._mode == ComparisonMode.FULL_CONTENT:
+            return filecmp.cmp(src, target, shallow=False)
+
+        src_stat = self._stat_cache.stat(src)
+        target_stat = self._stat_cache.stat(target)
+        if src_stat is None or target_stat is None:
+            return False
+        elif src_stat.st_size != target_stat.st_size:
+            return False
+        elif self._mode == ComparisonMode.SIZE_MTIME:
+            return src_stat.st_mtime_ns == target_stat.st_mtime_ns
+
+        # The target is a copy of the source as of the last run, so the
+        # checksum recorded back then is the checksum of the target.
+        self._digests[src] = self.digest(src)
+        target_digest = None if self._manifest is None else self._manifest.digest(src)
+        if target_digest is None:
+            target_digest = self.digest(target)
+        return self._digests[src] == target_digest
+
+    # Returns the checksum of a source file if it was computed while comparing.
+    def known_digest(self, path: Path) -> Optional[str]:
+        return self._digests.get(path)
+
+    @classmethod
+    def digest(cls, path: Path) -> str:
+        with open(path, "rb") as f:
+            return hashlib.file_digest(f, cls._hash_algorithm).hexdigest()
+
+
+class SchedulePolicy(Enum):
+    WALK = "walk"
+    LARGEST_FIRST = "largest-first"
+    BATCHED = "batched"
+
+    @classmethod
+    def values(cls) -> list[str]:
+        return ["walk", "largest-first", "batched"]
+
+
+class CopyScheduler:
+    # The fixed cost of copying a file (creating it, copying its metadata and
+    # renaming it) expressed as the number of bytes copied in the same time.
+    _file_overhead = 1 << 16
+    _small_file_size = 1 << 20
+    _max_batch_size = 1 << 24
+
+    class Task(NamedTuple):
+        src: Path | str
+        target: Path | str
+        size: int
+
+    # Orders the copies of a parallel run before they are handed to the
+    # worker threads:
+    # - walk:          In the order the files were found, each on its own.
+    #                  The copies are started while still walking the source.
+    # - largest-first: Largest files first, so no thread is still busy with
+    #                  a huge file which happened to be found last while the
+    #                  others idle.
+    # - batched:       Like largest-first, but small files are batched, so
+    #                  every thread copies a share of them in one go.  Small
+    #                  files keep the order they were found in (see
+    #                  TraversalOrder), which matters most for seeking.
+    # Other policies can be implemented by overriding plan().
+    def __init__(self, *, policy: SchedulePolicy, workers: int) -> None:
+        self.policy = policy
+        self._workers = workers
+        self._busy_cost = 0
+        self._busy_seconds = 0.0
+        self._lock = Lock()
+
+    # Returns the units of work in the order they should be started.
+    def plan(self, tasks: list[Task]) -> list[list[Task]]:
+        if self.policy == SchedulePolicy.WALK:
+            return [[task] for task in tasks]
+
+        ordered = sorted(tasks, key=lambda task: task.size, reverse=True)
+        if self.policy == SchedulePolicy.LARGEST_FIRST:
+            return [[task] for task in ordered]
+
+        units = [[task] for task in ordered if task.size >= self._small_file_size]
+        small = [task for task in tasks if task.size < self._small_file_size]
+        batch_size = min(
+            self._max_batch_size,
+            max(self._file_overhead, self.cost(small) // self._workers),
+        )
+        batch: list[CopyScheduler.Task] = []
+        for task in small:
+            batch.append(task)
+            if self.cost(batch) >= batch_size:
+                units.append(batch)
+                batch = []
+        if batch:
+            units.append(batch)
+        return units
+
+    def cost(self, unit: list[Task]) -> int:
+        return sum(task.size + self._file_overhead for task in unit)
+
+    # Returns the cost after which the last unit is expected to be done, if
+    # every unit is started by the first idle thread.
+    def estimate(self, units: list[list[Task]]) -> int:
+        finished = [0] * self._workers
+        for unit in units:
+            heapq.heappush(finished, heapq.heappop(finished) + self.cost(unit))
+        return max(finished)
+
+    # Called by the worker threads after a unit is done.
+    def record(self, unit: list[Task], seconds: float) -> None:
+        with self._lock:
+            self._busy_cost += self.cost(unit)
+            self._busy_seconds += seconds
+
+    # The estimated cost is converted to seconds using the throughput of the
+    # threads measured while copying.
+    def log_statistics(self, estimate: int, seconds: float, units: int) -> None:
+        if self._busy_cost == 0:
+            return
+        estimated = estimate * self._busy_seconds / self._busy_cost
+        logging.info(
+            f"Copied {units} units of work using {self._workers} threads "
+            f"({self.policy.value}): estimated makespan {estimated:.2f}s, "
+            f"actual {seconds:.2f}s"
+        )
 
 
 class CopyConflictMode(Enum):
@@ -233,100 +1188,525 @@ class CopyConflictMode(Enum):
 
 
 class CopyFiles:
+    # Whether to write a journal to the destination, so an interrupted run
+    # can be resumed.
+    _journaled = True
+
     def __init__(
         self,
         dest: Path,
         files: set[Path],
         *,
         conflict_mode: CopyConflictMode = CopyConflictMode.NO_OVERWRITE,
+        stat_cache: Optional[StatCache] = None,
+        jobs: int = 1,
+        reflink: ReflinkMode = ReflinkMode.AUTO,
+        comparison: ComparisonMode = ComparisonMode.SHALLOW,
+        incremental: bool = False,
+        delta_threshold: Optional[int] = None,
+        split_threshold: Optional[int] = None,
+        schedule: SchedulePolicy = SchedulePolicy.BATCHED,
+        order: TraversalOrder = TraversalOrder.DIRECTORY,
+        cache: CachePolicy = CachePolicy.KEEP,
+        direct_threshold: Optional[int] = None,
     ) -> None:
-        if not dest.exists():
+        if jobs < 1:
+            raise ValueError(f"The number of jobs must be positive, not {jobs}")
+        stat_cache = stat_cache if stat_cache is not None else StatCache()
+        if not stat_cache.exists(dest):
             raise FileNotFoundError(
                 f"The destination directory '{dest}' does not exist"
             )
-        if not dest.is_dir():
+        if not stat_cache.is_dir(dest):
             raise NotADirectoryError(
                 f"The destination path '{dest}' does not refer to a directory"
             )
-        self._dest = dest.resolve()
+        self._dest = stat_cache.resolve(dest)
         self._files = files
         self._conflict_mode = conflict_mode
+        self._stat_cache = stat_cache
+        self._jobs = jobs
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._pending: list[Future[Any]] = []
+        self._scheduler = CopyScheduler(policy=schedule, workers=jobs)
+        self._order = order
+        self._reader = DirectoryReader(order=order)
+        self._tasks: list[CopyScheduler.Task] = []
+        self._folders: dict[Path, Path] = {}
+        self._copier = FileCopier(
+            reflink=reflink,
+            delta_threshold=delta_threshold,
+            split_threshold=split_threshold,
+            split_threads=jobs,
+            cache=cache,
+            direct_threshold=direct_threshold,
+        )
+        self._manifest = Manifest(self._dest) if incremental else None
+        self._journal: Optional[Journal] = None
+        self._comparer = FileComparer(
+            mode=comparison, stat_cache=stat_cache, manifest=self._manifest
+        )
 
     def copy(self, *, pretend: bool = False) -> None:
         logging.info(f"Copying to backup directory '{self._dest}'")
+        if self._manifest is not None:
+            self._manifest.load()
+        if self._journaled and not pretend:
+            self._journal = Journal(self._dest)
+            self._journal.open()
+        if self._jobs > 1 and not pretend:
+            logging.debug(f"Copying files using {self._jobs} threads")
+            self._executor = ThreadPoolExecutor(max_workers=self._jobs)
+        complete = False
+        try:
+            self._copy(pretend=pretend)
+            self._wait_for_copies()
+            complete = True
+        finally:
+            try:
+                if not complete:
+                    self._cancel_copies()
+            finally:
+                self._copier.close()
+                if self._journal is not None:
+                    self._journal.close(complete=complete)
+        self._copier.log_statistics()
+        if self._manifest is not None and not pretend:
+            self._manifest.save()
+
+    def _copy(self, *, pretend: bool) -> None:
         logging.debug("Resolving paths")
-        for path in map(lambda p: Path.resolve(p), self._files):
+        for path in map(self._stat_cache.resolve, self._files):
             logging.debug(f"Source: '{path}")
-            target = self._concat_paths(self._dest, path)
+            target = self._target(path)
             logging.debug(f"Target: '{target}'")
-            if path.is_file():
+            if self._stat_cache.is_file(path):
                 logging.debug("Source is file")
-                copy: bool = False
-                if not target.exists():
-                    copy = True
-                elif filecmp.cmp(path, target):
-                    logging.info("Source and target are identical - skipping")
-                    copy = False
-                elif self._conflict_mode == CopyConflictMode.OVERWRITE:
-                    copy = True
-                elif self._conflict_mode == CopyConflictMode.ASK:
-                    copy = Util.overwrite_confirmation(path)
-
-                if copy:
-                    logging.info(f"Copying '{path}' to '{target}'")
-                    if not pretend:
-                        target.parent.mkdir(parents=True, exist_ok=True)
-                        copy2(path, target)
+                self._copy_file_if_needed(path, target, pretend=pretend)
             else:
                 logging.debug("Source is directory")
-                if not target.exists():
+                if not self._stat_cache.exists(target):
                     logging.info(f"Copying '{path}' to '{target}'")
                     if not pretend:
                         target.parent.mkdir(parents=True, exist_ok=True)
-                        copytree(path, target)
+                        self._copy_tree(path, target)
                 else:
                     self._merge_copy(path, target, pretend=pretend)
 
+    # Walks the source folder using os.scandir() instead of recursion.  The
+    # type of an entry is known from reading the folder, so no file needs to be
+    # stat'ed to find out whether it is a file or a folder.  Likewise, the
+    # target folder is read once instead of checking every target for
+    # existence.  Subfolders are visited in the order they were read.
     def _merge_copy(self, src: Path, dest: Path, pretend: bool = False) -> None:
         logging.debug(f"Merging '{src}' and '{dest}'")
-        for path in src.iterdir():
-            logging.debug(f"Source: '{path}'")
-            target = self._concat_paths(self._dest, path)
-            logging.debug(f"Target: '{target}'")
-            if path.is_file():
-                logging.debug("Source is file")
-                copy: bool = False
-                if not target.exists():
-                    copy = True
-                elif filecmp.cmp(path, target):
-                    logging.debug("Source and target are identical - skipping")
-                    copy = False
-                elif self._conflict_mode == CopyConflictMode.OVERWRITE:
-                    copy = True
-                elif self._conflict_mode == CopyConflictMode.ASK:
-                    copy = Util.overwrite_confirmation(path)
-
-                if copy:
-                    logging.info(f"Copying '{path}' to '{target}'")
-                    if not pretend:
-                        target.parent.mkdir(parents=True, exist_ok=True)
-                        copy2(path, target)
-            else:
-                if not target.exists():
+        folders = [(src, dest)]
+        while folders:
+            src_folder, dest_folder = folders.pop()
+            with os.scandir(dest_folder) as entries:
+                existing = {entry.name for entry in entries}
+            subfolders: list[tuple[Path, Path]] = []
+            for entry in self._reader.read(src_folder):
+                path = Path(entry.path)
+                logging.debug(f"Source: '{path}'")
+                target = dest_folder.joinpath(entry.name)
+                logging.debug(f"Target: '{target}'")
+                target_exists = entry.name in existing
+                if entry.is_file():
+                    logging.debug("Source is file")
+                    self._copy_file_if_needed(
+                        path, target, pretend=pretend, target_exists=target_exists
+                    )
+                elif not entry.is_dir():
+                    logging.warning(
+                        f"Path '{path}' is neither a file nor a folder. Is ignored."
+                    )
+                elif not target_exists:
                     logging.info(f"Copying '{path}' to '{target}'")
                     if not pretend:
-                        target.parent.mkdir(parents=True, exist_ok=True)
-                        copytree(path, target)
+                        self._copy_tree(path, target)
                 else:
-                    self._merge_copy(path, target, pretend=pretend)
+                    subfolders.append((path, target))
+            folders.extend(reversed(subfolders))
         logging.debug(f"Done merging '{src}' and '{dest}'")
 
+    def _copy_file_if_needed(
+        self,
+        path: Path,
+        target: Path,
+        pretend: bool,
+        target_exists: Optional[bool] = None,
+    ) -> None:
+        if self._manifest is not None and self._manifest.unchanged(
+            path, self._stat_cache.stat(path)
+        ):
+            logging.debug("Source is unchanged since the last backup - skipping")
+            return
+        if self._journal is not None and self._journal.done(
+            path, self._stat_cache.stat(path), self._stat_cache.stat(target)
+        ):
+            logging.debug("Source was done by the interrupted run - skipping")
+            return
+
+        if target_exists is None:
+            target_exists = self._stat_cache.exists(target)
+
+        copy: bool = False
+        if not target_exists:
+            copy = True
+        elif (
+            self._conflict_mode == CopyConflictMode.NO_OVERWRITE
+            and self._manifest is None
+        ):
+            logging.debug("Target already exists - skipping")
+            copy = False
+        elif self._comparer.identical(path, target):
+            logging.debug("Source and target are identical - skipping")
+            copy = False
+            stat = self._stat_cache.stat(path)
+            if self._manifest is not None and stat is not None:
+                self._manifest.add(path, stat, self._comparer.known_digest(path))
+            if self._journal is not None and stat is not None:
+                self._journal.finish(path, stat, FileCopier.temporary_path(target))
+        elif self._conflict_mode == CopyConflictMode.OVERWRITE:
+            copy = True
+        elif self._conflict_mode == CopyConflictMode.ASK:
+            copy = Util.overwrite_confirmation(path)
+
+        if copy:
+            logging.info(f"Copying '{path}' to '{target}'")
+            if not pretend:
+                target.parent.mkdir(parents=True, exist_ok=True)
+                self._copy_file(path, target)
+
+    # Folders are always created by the main thread, so they exist before any
+    # file is copied into them.  Only the file contents are copied by the
+    # worker threads.  Decisions about conflicts (including asking the user)
+    # are made on the main thread as well, before a copy is scheduled.
+    def _copy_file(self, src: Path, target: Path) -> None:
+        if self._executor is None:
+            self._copy_and_record(src, target)
+        else:
+            self._schedule(src, target)
+        self._stat_cache.invalidate(target)
+
+    def _copy_tree(self, src: Path, target: Path) -> None:
+        copy_function = (
+            self._copy_and_record if self._executor is None else self._copy_tree_file
+        )
+        if self._order == TraversalOrder.DIRECTORY:
+            copytree(src, target, copy_function=copy_function)
+        else:
+            self._copy_tree_ordered(src, target, copy_function)
+        self._stat_cache.invalidate(target)
+
+    # Like copytree(), but reads every folder using the DirectoryReader and
+    # visits the subfolders in the order they were read.
+    def _copy_tree_ordered(
+        self, src: Path, target: Path, copy_function: Callable[[str, str], None]
+    ) -> None:
+        folders = [(src, target)]
+        copied: list[tuple[Path, Path]] = []
+        while folders:
+            src_folder, target_folder = folders.pop()
+            target_folder.mkdir()
+            subfolders: list[tuple[Path, Path]] = []
+            for entry in self._reader.read(src_folder):
+                path = target_folder.joinpath(entry.name)
+                if entry.is_dir():
+                    subfolders.append((Path(entry.path), path))
+                elif entry.is_file():
+                    copy_function(entry.path, str(path))
+                else:
+                    logging.warning(
+                        f"Path '{entry.path}' is neither a file nor a folder. "
+                        "Is ignored."
+                    )
+            folders.extend(reversed(subfolders))
+            copied.append((src_folder, target_folder))
+        for src_folder, target_folder in reversed(copied):
+            copystat(src_folder, target_folder)
+
+    def _copy_tree_file(self, src: str, target: str) -> None:
+        self._schedule(src, target)
+        # copytree() copies the metadata of a folder right after scheduling
+        # the copies of its files.  Writing those files later changes the
+        # modification time again, so the metadata is copied once more after
+        # all files are written.
+        self._folders[Path(target).parent] = Path(src).parent
+
+    # Except for the walk policy the copies are only started after all of them
+    # are known, see _run_tasks().
+    def _schedule(self, src: Path | str, target: Path | str) -> None:
+        assert self._executor is not None
+        if self._scheduler.policy == SchedulePolicy.WALK:
+            self._pending.append(
+                self._executor.submit(self._copy_and_record, src, target)
+            )
+        else:
+            # The walk usually stat()ed the source already.
+            stat = self._stat_cache.stat(Path(src))
+            size = stat.st_size if stat is not None else 0
+            self._tasks.append(CopyScheduler.Task(src, target, size))
+
+    def _run_tasks(
+        self, executor: ThreadPoolExecutor, tasks: list[CopyScheduler.Task]
+    ) -> None:
+        units = self._scheduler.plan(tasks)
+        estimate = self._scheduler.estimate(units)
+        start = perf_counter()
+        futures = [executor.submit(self._copy_unit, unit) for unit in units]
+        for future in futures:
+            future.result()
+        self._scheduler.log_statistics(estimate, perf_counter() - start, len(units))
+
+    def _copy_unit(self, unit: list[CopyScheduler.Task]) -> None:
+        start = perf_counter()
+        for task in unit:
+            self._copy_and_record(task.src, task.target)
+        self._scheduler.record(unit, perf_counter() - start)
+
+    def _copy_and_record(self, src: Path | str, target: Path | str) -> None:
+        temporary = FileCopier.temporary_path(Path(target))
+        if self._journal is not None:
+            self._journal.start(temporary)
+        stat = self._copier.copy(src, target)
+        if self._manifest is not None:
+            self._manifest.add(Path(src), stat)
+        if self._journal is not None:
+            self._journal.finish(Path(src), stat, temporary)
+
+    def _wait_for_copies(self) -> None:
+        if self._executor is None:
+            return
+
+        executor, self._executor = self._executor, None
+        tasks, self._tasks = self._tasks, []
+        try:
+            if tasks:
+                self._run_tasks(executor, tasks)
+        except BaseException:
+            executor.shutdown(wait=True, cancel_futures=True)
+            raise
+        executor.shutdown(wait=True)
+        pending, self._pending = self._pending, []
+        folders, self._folders = self._folders, {}
+        for future in pending:
+            future.result()
+        for target, src in folders.items():
+            copystat(src, target)
+
+    # Called if the run failed or was interrupted: The copies which have not
+    # been started yet are dropped instead of started.
+    def _cancel_copies(self) -> None:
+        if self._executor is None:
+            return
+
+        executor, self._executor = self._executor, None
+        self._tasks, self._pending, self._folders = [], [], {}
+        executor.shutdown(wait=True, cancel_futures=True)
+
+    def _target(self, path: Path) -> Path:
+        return self._concat_paths(self._dest, path)
+
     @staticmethod
     def _concat_paths(p1: Path, p2: Path) -> Path:
         return Path(str(p1) + str(p2))
 
 
+class RestoreFiles(CopyFiles):
+    _journaled = False
+
+    # Copies files and folders from a backup folder back to their original
+    # location (or into the given target folder), which inverts the mapping
+    # of CopyFiles: The copy of '/home/user/file' in the backup folder
+    # '/backup' is '/backup/home/user/file'.
+    def __init__(
+        self,
+        backup: Path,
+        paths: list[Path],
+        *,
+        target: Optional[Path] = None,
+        conflict_mode: CopyConflictMode = CopyConflictMode.NO_OVERWRITE,
+        stat_cache: Optional[StatCache] = None,
+        jobs: int = 1,
+        reflink: ReflinkMode = ReflinkMode.AUTO,
+        comparison: ComparisonMode = ComparisonMode.SHALLOW,
+    ) -> None:
+        stat_cache = stat_cache if stat_cache is not None else StatCache()
+        if not stat_cache.is_dir(backup):
+            raise NotADirectoryError(
+                f"The backup path '{backup}' does not refer to a directory"
+            )
+        self._backup = stat_cache.resolve(backup)
+        files: set[Path] = set()
+        for path in paths:
+            copy = self._concat_paths(self._backup, path.absolute())
+            if stat_cache.exists(copy):
+                files.add(copy)
+            else:
+                logging.warning(f"Path '{path}' is not in the backup. Is ignored.")
+        super().__init__(
+            target if target is not None else Path("/"),
+            files,
+            conflict_mode=conflict_mode,
+            stat_cache=stat_cache,
+            jobs=jobs,
+            reflink=reflink,
+            comparison=comparison,
+        )
+
+    def copy(self, *, pretend: bool = False) -> None:
+        logging.info(f"Restoring from backup directory '{self._backup}'")
+        super().copy(pretend=pretend)
+
+    def _target(self, path: Path) -> Path:
+        return self._dest.joinpath(path.relative_to(self._backup))
+
+
+class SnapshotFiles(CopyFiles):
+    _name_format = "%Y-%m-%d_%H-%M-%S"
+
+    # Creates a new snapshot folder named after the current time inside the
+    # destination in every run.  Files which are unchanged compared to their
+    # copy in the latest snapshot are hard linked to that copy instead of
+    # being copied, so a snapshot only costs the space and time of the
+    # changed files.  The snapshot is written to a '.partial' folder which is
+    # renamed when complete (or resumed by the next run, if interrupted).  If
+    # keep is given, only the latest keep snapshots are kept.
+    def __init__(
+        self,
+        dest: Path,
+        files: set[Path],
+        *,
+        conflict_mode: CopyConflictMode = CopyConflictMode.NO_OVERWRITE,
+        stat_cache: Optional[StatCache] = None,
+        jobs: int = 1,
+        reflink: ReflinkMode = ReflinkMode.AUTO,
+        comparison: ComparisonMode = ComparisonMode.SHALLOW,
+        keep: Optional[int] = None,
+        split_threshold: Optional[int] = None,
+        schedule: SchedulePolicy = SchedulePolicy.BATCHED,
+        order: TraversalOrder = TraversalOrder.DIRECTORY,
+        cache: CachePolicy = CachePolicy.KEEP,
+        direct_threshold: Optional[int] = None,
+    ) -> None:
+        if keep is not None and keep < 1:
+            raise ValueError(
+                f"The number of snapshots to keep must be positive, not {keep}"
+            )
+        super().__init__(
+            dest,
+            files,
+            conflict_mode=conflict_mode,
+            stat_cache=stat_cache,
+            jobs=jobs,
+            reflink=reflink,
+            comparison=comparison,
+            split_threshold=split_threshold,
+            schedule=schedule,
+            order=order,
+            cache=cache,
+            direct_threshold=direct_threshold,
+        )
+        self._root = self._dest
+        snapshots = self.snapshots(self._root)
+        self._previous = snapshots[-1] if snapshots else None
+        self._snapshot = self._root.joinpath(datetime.now().strftime(self._name_format))
+        if self._snapshot.exists():
+            raise FileExistsError(f"The snapshot '{self._snapshot}' already exists")
+        # The snapshot of an interrupted run is completed by this run.
+        partial = sorted(self._root.glob("*.partial"))
+        self._dest = (
+            partial[-1]
+            if partial
+            else self._snapshot.with_name(self._snapshot.name + ".partial")
+        )
+        self._keep = keep
+        self._linked = 0
+        self._lock = Lock()
+
+    # Returns the complete snapshots inside of the folder, oldest first.
+    @classmethod
+    def snapshots(cls, root: Path) -> list[Path]:
+        snapshots: list[Path] = []
+        with os.scandir(root) as entries:
+            for entry in entries:
+                try:
+                    datetime.strptime(entry.name, cls._name_format)
+                except ValueError:
+                    continue
+                if entry.is_dir(follow_symlinks=False):
+                    snapshots.append(Path(entry.path))
+        return sorted(snapshots)
+
+    def copy(self, *, pretend: bool = False) -> None:
+        logging.info(f"Creating snapshot '{self._snapshot}'")
+        if self._previous is not None:
+            logging.info(f"Linking unchanged files to snapshot '{self._previous}'")
+        if not pretend:
+            self._dest.mkdir(exist_ok=True)
+        super().copy(pretend=pretend)
+        logging.info(f"Linked {self._linked} unchanged files")
+        if pretend:
+            return
+
+        os.rename(self._dest, self._snapshot)
+        if self._keep is not None:
+            for snapshot in self.snapshots(self._root)[: -self._keep]:
+                logging.info(f"Removing snapshot '{snapshot}'")
+                rmtree(snapshot)
+
+    def _copy_and_record(self, src: Path | str, target: Path | str) -> None:
+        if self._previous is not None:
+            previous = self._previous.joinpath(Path(target).relative_to(self._dest))
+            if self._stat_cache.is_file(previous) and self._comparer.identical(
+                Path(src), previous
+            ):
+                logging.debug(f"Linking '{target}' to '{previous}'")
+                os.link(previous, target)
+                with self._lock:
+                    self._linked += 1
+                return
+        super()._copy_and_record(src, target)
+
+
 class Util:
+    @staticmethod
+    def parse_size(size: str) -> int:
+        units = {"": 1, "K": 1 << 10, "M": 1 << 20, "G": 1 << 30, "T": 1 << 40}
+        value = size.strip().upper().removesuffix("B").removesuffix("I")
+        unit = value[-1:] if value[-1:] in units else ""
+        return int(float(value[: len(value) - len(unit)]) * units[unit])
+
+    @staticmethod
+    def format_size(size: float) -> str:
+        for unit in ["B", "KiB", "MiB", "GiB"]:
+            if size < 1024:
+                return f"{size:.1f} {unit}"
+            size /= 1024
+        return f"{size:.1f} TiB"
+
+    # Whether the path is one of the given (absolute) paths or inside of one.
+    @staticmethod
+    def is_below(path: str, parents: list[str]) -> bool:
+        return any(
+            path == parent or path.startswith(parent.rstrip("/") + "/")
+            for parent in parents
+        )
+
+    # Existing folders are merged.
+    @staticmethod
+    def may_overwrite(target: Path, conflict_mode: CopyConflictMode) -> bool:
+        if not target.exists() or target.is_dir():
+            return True
+        elif conflict_mode == CopyConflictMode.OVERWRITE:
+            return True
+        elif conflict_mode == CopyConflictMode.ASK:
+            return Util.overwrite_confirmation(target)
+        logging.debug(f"Target '{target}' already exists - skipping")
+        return False
+
     @staticmethod
     def overwrite_confirmation(path: Path) -> bool:
         confirmations = ["", "y", "yes"]
@@ -344,9 +1724,467 @@ class NoDefaultFilenameAvailableError(Exception):
     pass
 
 
+class Compressibility:
+    _probe_size = 1 << 16
+    # Compressing the probe must save at least this fraction of its size.
+    _min_savings = 0.05
+    # File types which are (almost) always compressed already.
+    _compressed_suffixes = set(
+        # Images
+        ".jpg .jpeg .png .gif .webp .heic .avif "
+        # Audio and video
+        ".mp3 .aac .ogg .opus .flac .m4a .mp4 .m4v .mkv .mov .avi .webm "
+        # Archives and compressed files
+        ".zip .gz .tgz .bz2 .xz .txz .zst .7z .rar "
+        # Documents and packages which are zip archives
+        ".docx .xlsx .pptx .odt .ods .odp .epub .jar .apk .whl".split()
+    )
+
+    # Decides cheaply whether compressing some data is worth the CPU time: The
+    # first block is compressed using the fastest compression level.  If this
+    # does not save anything, compressing the rest will not save much either.
+    @classmethod
+    def probe(cls, data: bytes) -> bool:
+        sample = data[: cls._probe_size]
+        if not sample:
+            return True
+        compressed = zlib.compress(sample, 1)
+        return len(compressed) <= (1 - cls._min_savings) * len(sample)
+
+    # A block of an archive may contain several files, so samples are taken
+    # from its start, middle and end.  The block is only considered
+    # incompressible if none of them compresses.
+    @classmethod
+    def probe_block(cls, block: bytes) -> bool:
+        offsets = {0, (len(block) - cls._probe_size) // 2, len(block) - cls._probe_size}
+        return any(
+            cls.probe(block[offset : offset + cls._probe_size])
+            for offset in sorted(max(offset, 0) for offset in offsets)
+        )
+
+    @classmethod
+    def is_compressible(cls, path: Path) -> bool:
+        if path.suffix.lower() in cls._compressed_suffixes:
+            return False
+        with open(path, "rb") as f:
+            return cls.probe(f.read(cls._probe_size))
+
+
+class ParallelCompressedFile(io.BufferedIOBase, ABC):
+    _block_size = 1 << 20
+
+    # Splits the data written to it into blocks which are compressed
+    # concurrently by a pool of threads (the compression libraries release the
+    # GIL while compressing).  The compressed blocks are written to the
+    # underlying file in order.  At most twice as many blocks as there are
+    # threads are held in memory at any time.
+    # If adaptive is set blocks which do not compress well are stored as is.
+    # The offsets of the blocks are recorded, so a reader can start
+    # decompressing at any block (see decompress_block()).
+    def __init__(self, raw: IO[bytes], *, threads: int, adaptive: bool = False) -> None:
+        super().__init__()
+        self._raw = raw
+        self._adaptive = adaptive
+        self._stored_blocks = 0
+        self._executor = ThreadPoolExecutor(max_workers=threads)
+        self._max_pending = 2 * threads
+        self._pending: deque[tuple[int, bytes, Future[bytes]]] = deque()
+        self._blocks = 0
+        self._buffer = bytearray()
+        self._previous = b""
+        self._size = 0
+        self._offsets: list[tuple[int, int]] = []
+        header = self._header()
+        raw.write(header)
+        self._compressed_size = len(header)
+
+    @abstractmethod
+    def _header(self) -> bytes:
+        raise NotImplementedError("Implement _header() -> bytes")
+
+    # Compresses a single block.  Called concurrently from the worker threads.
+    @abstractmethod
+    def _compress(self, index: int, block: bytes, previous: bytes, last: bool) -> bytes:
+        raise NotImplementedError(
+            "Implement _compress(index: int, block: bytes, previous: bytes, "
+            "last: bool) -> bytes"
+        )
+
+    # Called by the worker threads to decide how to compress a block.
+    def _store(self, block: bytes) -> bool:
+        return self._adaptive and not Compressibility.probe_block(block)
+
+    # Called in order for every block after it has been written.
+    def _written(self, index: int, block: bytes, compressed: bytes) -> None:
+        pass
+
+    @abstractmethod
+    def _trailer(self) -> bytes:
+        raise NotImplementedError("Implement _trailer() -> bytes")
+
+    # Decompresses the data of a single block, which starts at the beginning
+    # of the given data and may be followed by other data.
+    @classmethod
+    @abstractmethod
+    def decompress_block(cls, data: bytes) -> bytes:
+        raise NotImplementedError("Implement decompress_block(data: bytes) -> bytes")
+
+    # Pairs of the uncompressed and the compressed offset of every block
+    # followed by the offsets of the end of the last block.  Complete after
+    # the file has been closed.
+    @property
+    def offsets(self) -> list[tuple[int, int]]:
+        return self._offsets
+
+    def writable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self._size
+
+    def write(self, data: Any) -> int:
+        data = memoryview(data).cast("B")
+        self._buffer += data
+        self._size += len(data)
+        while len(self._buffer) >= self._block_size:
+            block = bytes(self._buffer[: self._block_size])
+            del self._buffer[: self._block_size]
+            self._submit(block, last=False)
+        return len(data)
+
+    def _submit(self, block: bytes, last: bool) -> None:
+        index = self._blocks
+        future = self._executor.submit(
+            self._compress, index, block, self._previous, last
+        )
+        self._pending.append((index, block, future))
+        self._previous = block
+        self._blocks += 1
+        while len(self._pending) > self._max_pending:
+            self._write_next()
+
+    def _write_next(self) -> None:
+        index, block, future = self._pending.popleft()
+        compressed = future.result()
+        self._raw.write(compressed)
+        self._offsets.append((index * self._block_size, self._compressed_size))
+        self._compressed_size += len(compressed)
+        self._written(index, block, compressed)
+
+    def close(self) -> None:
+        if self.closed:
+            return
+        try:
+            self._submit(bytes(self._buffer), last=True)
+            self._buffer = bytearray()
+            while self._pending:
+                self._write_next()
+            self._offsets.append((self._size, self._compressed_size))
+            self._raw.write(self._trailer())
+            if self._adaptive:
+                logging.info(
+                    f"Stored {self._stored_blocks} of {self._blocks} blocks "
+                    "without compression"
+                )
+        finally:
+            self._executor.shutdown(wait=True, cancel_futures=True)
+            super().close()
+
+
+class ParallelGzipFile(ParallelCompressedFile):
+    _dictionary_size = 1 << 15
+
+    # Compresses the data like pigz: Every block is a raw deflate stream ending
+    # at a byte boundary (using a sync flush), so the compressed blocks can
+    # simply be concatenated to one gzip member.  The last 32 KiB of the
+    # previous block are used as dictionary, so the compression ratio barely
+    # suffers.  The checksum of the uncompressed data is computed sequentially.
+    # If independent is set no dictionary is used, so every block can be
+    # decompressed on its own.
+    def __init__(
+        self,
+        raw: IO[bytes],
+        *,
+        threads: int,
+        level: int = 9,
+        adaptive: bool = False,
+        independent: bool = False,
+    ) -> None:
+        self._level = level
+        self._independent = independent
+        self._crc = 0
+        super().__init__(raw, threads=threads, adaptive=adaptive)
+
+    def _header(self) -> bytes:
+        magic = b"\x1f\x8b"
+        deflate = b"\x08"
+        flags = b"\x00"
+        mtime = struct.pack("<L", int(time()))
+        extra_flags = (
+            b"\x02" if self._level == 9 else b"\x04" if self._level == 1 else b"\x00"
+        )
+        unix = b"\x03"
+        return magic + deflate + flags + mtime + extra_flags + unix
+
+    def _compress(self, index: int, block: bytes, previous: bytes, last: bool) -> bytes:
+        dictionary = b"" if self._independent else previous[-self._dictionary_size :]
+        level = 0 if self._store(block) else self._level
+        if dictionary:
+            compressor = zlib.compressobj(
+                level, zlib.DEFLATED, -zlib.MAX_WBITS, zdict=dictionary
+            )
+        else:
+            compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+        flush = zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH
+        return compressor.compress(block) + compressor.flush(flush)
+
+    def _written(self, index: int, block: bytes, compressed: bytes) -> None:
+        self._crc = zlib.crc32(block, self._crc)
+        if len(compressed) >= len(block) > 0:
+            self._stored_blocks += 1
+
+    def _trailer(self) -> bytes:
+        return struct.pack("<LL", self._crc, self._size & 0xFFFFFFFF)
+
+    # Only works for blocks written with independent set.
+    @classmethod
+    def decompress_block(cls, data: bytes) -> bytes:
+        return zlib.decompressobj(-zlib.MAX_WBITS).decompress(data)
+
+
+class ParallelXzFile(ParallelCompressedFile):
+    _dictionary_size = 1 << 23
+    # Same block size as used by "xz --threads".
+    _block_size = 3 * _dictionary_size
+    _magic = b"\xfd7zXZ\x00"
+    _crc32_flags = b"\x00\x01"
+
+    # Writes a single .xz stream consisting of independently compressed blocks
+    # (see the .xz file format specification).  Each block holds the raw LZMA2
+    # data of one chunk together with a header and a CRC32 of the chunk.  The
+    # index at the end of the stream lists the sizes of all blocks.
+    def __init__(
+        self,
+        raw: IO[bytes],
+        *,
+        threads: int,
+        preset: int = 6,
+        adaptive: bool = False,
+    ) -> None:
+        self._preset = preset
+        self._records: list[tuple[int, int]] = []
+        self._unpadded_sizes: dict[int, int] = {}
+        super().__init__(raw, threads=threads, adaptive=adaptive)
+
+    @staticmethod
+    def _varint(value: int) -> bytes:
+        result = bytearray()
+        while value >= 0x80:
+            result.append(value & 0x7F | 0x80)
+            value >>= 7
+        result.append(value)
+        return bytes(result)
+
+    @staticmethod
+    def _padding(size: int) -> bytes:
+        return b"\x00" * (-size % 4)
+
+    @staticmethod
+    def _crc32(data: bytes) -> bytes:
+        return struct.pack("<L", zlib.crc32(data))
+
+    def _header(self) -> bytes:
+        return self._magic + self._crc32_flags + self._crc32(self._crc32_flags)
+
+    # The LZMA2 dictionary size is encoded as (2 | (bits & 1)) << (bits // 2 + 11).
+    def _block_header(self) -> bytes:
+        lzma2 = b"\x21"
+        bits = 2 * (self._dictionary_size.bit_length() - 1 - 12)
+        filter_flags = lzma2 + self._varint(1) + bytes([bits])
+        flags = b"\x00"  # One filter, no optional sizes
+        size = 1 + len(flags) + len(filter_flags)
+        header_size = size + len(self._padding(size)) + 4
+        header = (
+            bytes([header_size // 4 - 1]) + flags + filter_flags + self._padding(size)
+        )
+        return header + self._crc32(header)
+
+    def _compress(self, index: int, block: bytes, previous: bytes, last: bool) -> bytes:
+        filters = [
+            {
+                "id": lzma.FILTER_LZMA2,
+                "preset": self._preset,
+                "dict_size": self._dictionary_size,
+            }
+        ]
+        if self._store(block):
+            data = self._uncompressed_lzma2(block)
+        else:
+            data = lzma.compress(block, format=lzma.FORMAT_RAW, filters=filters)
+        header = self._block_header()
+        check = self._crc32(block)
+        # The index stores the size of a block without the padding.
+        self._unpadded_sizes[index] = len(header) + len(data) + len(check)
+        return header + data + self._padding(len(data)) + check
+
+    # LZMA2 data can contain uncompressed chunks of up to 64 KiB each.  The
+    # first chunk resets the dictionary, the others do not.
+    @staticmethod
+    def _uncompressed_lzma2(block: bytes) -> bytes:
+        chunk_size = 1 << 16
+        data = bytearray()
+        for offset in range(0, len(block), chunk_size):
+            chunk = block[offset : offset + chunk_size]
+            data += b"\x01" if offset == 0 else b"\x02"
+            data += struct.pack(">H", len(chunk) - 1) + chunk
+        return bytes(data + b"\x00")
+
+    def _written(self, index: int, block: bytes, compressed: bytes) -> None:
+        self._records.append((self._unpadded_sizes.pop(index), len(block)))
+        if len(compressed) >= len(block) > 0:
+            self._stored_blocks += 1
+
+    def _trailer(self) -> bytes:
+        index = bytearray(b"\x00")
+        index += self._varint(len(self._records))
+        for unpadded_size, uncompressed_size in self._records:
+            index += self._varint(unpadded_size) + self._varint(uncompressed_size)
+        index += self._padding(len(index))
+        index += self._crc32(bytes(index))
+
+        backward_size = struct.pack("<L", len(index) // 4 - 1)
+        footer = backward_size + self._crc32_flags
+        return bytes(index) + self._crc32(footer) + footer + b"YZ"
+
+    # The size of the block header is stored in its first byte.
+    @classmethod
+    def decompress_block(cls, data: bytes) -> bytes:
+        header_size = (data[0] + 1) * 4
+        filters = [{"id": lzma.FILTER_LZMA2, "dict_size": cls._dictionary_size}]
+        decompressor = lzma.LZMADecompressor(lzma.FORMAT_RAW, filters=filters)
+        return decompressor.decompress(data[header_size:])
+
+
+class CompressedBlockReader(io.RawIOBase):
+    # Reads the uncompressed data of a file written by a ParallelCompressedFile
+    # starting at an arbitrary offset.  Only the blocks from the one containing
+    # the offset onwards are read and decompressed, one at a time.
+    def __init__(
+        self,
+        raw: IO[bytes],
+        compressed_file: type[ParallelCompressedFile],
+        offsets: list[tuple[int, int]],
+        offset: int,
+    ) -> None:
+        super().__init__()
+        self._raw = raw
+        self._compressed_file = compressed_file
+        self._offsets = offsets
+        self._block = bisect_right([start for start, _ in offsets], offset) - 1
+        self._skip = offset - offsets[max(self._block, 0)][0]
+        self._buffer = memoryview(b"")
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer: Any) -> int:
+        while not self._buffer and 0 <= self._block < len(self._offsets) - 1:
+            start = self._offsets[self._block][1]
+            end = self._offsets[self._block + 1][1]
+            self._raw.seek(start)
+            data = self._compressed_file.decompress_block(self._raw.read(end - start))
+            self._buffer = memoryview(data)[self._skip :]
+            self._skip = 0
+            self._block += 1
+        size = min(len(buffer), len(self._buffer))
+        buffer[:size] = self._buffer[:size]
+        self._buffer = self._buffer[size:]
+        return size
+
+
+class ArchiveIndex:
+    _suffix = ".index"
+    _version = 1
+
+    class Volume(NamedTuple):
+        file: str
+        # The offsets of the members in the uncompressed archive
+        members: dict[str, int]
+        # See ParallelCompressedFile.offsets
+        blocks: list[tuple[int, int]]
+
+    # Lists the members of an archive (or of all of its volumes) by their
+    # original path, together with their offsets in the uncompressed archive.
+    # For archives compressed in independent blocks the offsets of the blocks
+    # are listed as well, so a member can be read without decompressing the
+    # archive from the start.
+    def __init__(self, path: Path, algorithm: str) -> None:
+        self._path = path
+        self.algorithm = algorithm
+        self.volumes: list[ArchiveIndex.Volume] = []
+
+    @classmethod
+    def path_for(cls, archive: Path) -> Path:
+        return archive.with_name(archive.name + cls._suffix)
+
+    # Returns the index of the given archive (or the given index itself).
+    @classmethod
+    def find(cls, archive: Path) -> Optional[Path]:
+        if archive.name.endswith(cls._suffix):
+            return archive
+        index = cls.path_for(archive)
+        return index if index.exists() else None
+
+    def volume_path(self, volume: "ArchiveIndex.Volume") -> Path:
+        return self._path.with_name(volume.file)
+
+    @classmethod
+    def load(cls, path: Path) -> "ArchiveIndex":
+        logging.info(f"Reading index '{path}'")
+        try:
+            with open(path) as f:
+                content = json.load(f)
+            if content.get("version") != cls._version:
+                raise ValueError(f"Unknown version {content.get('version')}")
+            index = ArchiveIndex(path, content["algorithm"])
+            for volume in content["volumes"]:
+                index.add(
+                    volume["file"],
+                    volume["members"],
+                    [(start, offset) for start, offset in volume.get("blocks", [])],
+                )
+        except (KeyError, TypeError, AttributeError) as e:
+            raise ValueError(f"Index '{path}' is invalid ({e})")
+        return index
+
+    def add(
+        self, file: str, members: dict[str, int], blocks: list[tuple[int, int]]
+    ) -> None:
+        self.volumes.append(ArchiveIndex.Volume(file, members, blocks))
+
+    def save(self) -> None:
+        logging.info(f"Writing index '{self._path}'")
+        content = {
+            "version": self._version,
+            "algorithm": self.algorithm,
+            "volumes": [volume._asdict() for volume in self.volumes],
+        }
+        tmp = self._path.with_name(self._path.name + ".tmp")
+        with open(tmp, "w") as f:
+            json.dump(content, f)
+        os.replace(tmp, self._path)
+
+
 class Compression:
     _default_name = "backup.sbu"
     _max_index = 100
+    _min_volume_size = tarfile.RECORDSIZE
+    # Upper bounds of the space needed by the headers of a zip member besides
+    # its name (the local file header and the central directory entry, both
+    # with a Zip64 extra field) and by the end of the central directory
+    # (including the Zip64 records).
+    _zip_member_overhead = 30 + 20 + 46 + 28
+    _zip_trailer_size = 22 + 56 + 20
 
     class Algorithm(Enum):
         ZIP = "zip"
@@ -376,7 +2214,17 @@ class Compression:
         algorithm: Algorithm,
         *,
         conflict_mode: CopyConflictMode = CopyConflictMode.NO_OVERWRITE,
+        stat_cache: Optional[StatCache] = None,
+        threads: int = 1,
+        adaptive: bool = False,
+        level: Optional[int] = None,
+        volume_size: Optional[int] = None,
+        indexed: bool = False,
     ) -> None:
+        if threads < 1:
+            raise ValueError(f"The number of threads must be positive, not {threads}")
+        if volume_size is not None and volume_size < self._min_volume_size:
+            raise ValueError(f"The volume size {volume_size} is too small")
         if not dest.parent.exists():
             raise NotADirectoryError(
                 f"The destination directory '{dest.parent}' does not exist!"
@@ -386,7 +2234,7 @@ class Compression:
         if dest.exists() and dest.is_dir():
             dest = dest.joinpath(self._default_name + extension)
             i: int = 1
-            while dest.exists() and i <= self._max_index:
+            while self._taken(dest) and i <= self._max_index:
                 dest = dest.parent.joinpath(
                     self._default_name + "-" + str(i) + extension
                 )
@@ -402,10 +2250,27 @@ class Compression:
         self._files = files
         self._algorithm = algorithm
         self._conflict_mode = conflict_mode
+        self._stat_cache = stat_cache if stat_cache is not None else StatCache()
+        self._threads = threads
+        self._adaptive = adaptive
+        self._level = level
+        self._volume_size = volume_size
+        self._indexed = indexed
+
+    # An archive split into volumes does not exist under its own name, but it
+    # has got an index file.
+    @staticmethod
+    def _taken(dest: Path) -> bool:
+        return dest.exists() or ArchiveIndex.path_for(dest).exists()
+
+    def _volume_path(self, number: int) -> Path:
+        extension = self._algorithm.file_extension()
+        stem = self._dest.name[: -len(extension)]
+        return self._dest.with_name(f"{stem}.vol{number:03d}{extension}")
 
     def compress_files(self, pretend: bool = False) -> None:
         logging.info(f"Compressing files to '{self._dest}'")
-        if self._dest.exists():
+        if self._taken(self._dest):
             logging.warning("Destination already exists!")
             copy = self._conflict_mode == CopyConflictMode.OVERWRITE
             if not copy and self._conflict_mode == CopyConflictMode.ASK:
@@ -415,15 +2280,888 @@ class Compression:
                 logging.info("No files are compressed")
                 return
 
-        with TemporaryDirectory(prefix="sbu_") as d:
-            tmpdir = Path(d)
-            logging.debug(f"Created temporary directory: '{tmpdir}'")
-            copy_files = CopyFiles(tmpdir, self._files)
-            copy_files.copy(pretend=pretend)
-            logging.info("Creating archive")
-            extension = self._algorithm.file_extension()
-            dest = self._dest.parent.joinpath(self._dest.name[: -len(extension)])
-            make_archive(str(dest), self._algorithm.value, tmpdir, ".", False, pretend)
+        if self._volume_size is not None:
+            self._compress_volumes(pretend)
+            return
+
+        logging.info("Creating archive")
+        if pretend:
+            for path, _ in self._entries():
+                logging.info(f"Adding '{path}'")
+        else:
+            volume = self._write(self._dest, self._entries(), self._threads)
+            if self._indexed:
+                index = ArchiveIndex(
+                    ArchiveIndex.path_for(self._dest), self._algorithm.value
+                )
+                index.add(*volume)
+                index.save()
+
+    # Every volume is a complete archive on its own, which contains all of
+    # the folders leading to its files.  The volumes are written concurrently,
+    # each by a single thread.  The index is always written, since it is the
+    # only place listing the volumes.
+    def _compress_volumes(self, pretend: bool) -> None:
+        volumes = self._volumes()
+        logging.info(f"Creating {len(volumes)} volumes")
+        if pretend:
+            for number, entries in enumerate(volumes, start=1):
+                for path, _ in entries:
+                    logging.info(f"Adding '{path}' to '{self._volume_path(number)}'")
+            return
+
+        index = ArchiveIndex(ArchiveIndex.path_for(self._dest), self._algorithm.value)
+        with ThreadPoolExecutor(max_workers=self._threads) as executor:
+            futures = [
+                executor.submit(self._write, self._volume_path(number), entries, 1)
+                for number, entries in enumerate(volumes, start=1)
+            ]
+            for future in futures:
+                index.add(*future.result())
+        index.save()
+
+    # Splits the entries into volumes such that the uncompressed contents
+    # (including the metadata) of each volume fit into the volume size.  So
+    # the (compressed) volumes fit as well.  Only a single file which is
+    # larger than the volume size gets a volume of its own, which is larger.
+    def _volumes(self) -> list[list[tuple[Path, str]]]:
+        assert self._volume_size is not None
+        # Computes the tar headers the same way the archives are written.
+        sizer = (
+            None
+            if self._algorithm == Compression.Algorithm.ZIP
+            else tarfile.TarFile(fileobj=io.BytesIO(), mode="w", dereference=True)
+        )
+        empty = 0 if sizer is None else self._member_size(sizer, Path("/"), "")
+        volumes: list[list[tuple[Path, str]]] = []
+        volume: list[tuple[Path, str]] = []
+        names: set[str] = set()
+        size = empty
+        # A volume holding only folders is never closed, its folders are
+        # needed by the files which follow anyway.
+        has_files = False
+        for path, name in self._entries():
+            is_file = self._stat_cache.is_file(path)
+            entry_size = self._member_size(sizer, path, name)
+            if self._archive_size(empty + entry_size) > self._volume_size:
+                logging.warning(f"File '{path}' is larger than the volume size")
+            parents = self._missing_parents(name, names)
+            parents_size = sum(self._member_size(sizer, *parent) for parent in parents)
+            if (
+                has_files
+                and self._archive_size(size + parents_size + entry_size)
+                > self._volume_size
+            ):
+                volumes.append(volume)
+                volume, names, size, has_files = [], set(), empty, False
+                parents = self._missing_parents(name, names)
+                parents_size = sum(
+                    self._member_size(sizer, *parent) for parent in parents
+                )
+
+            for parent in parents:
+                names.add(parent[1])
+                volume.append(parent)
+            names.add(name)
+            volume.append((path, name))
+            size += parents_size + entry_size
+            has_files = has_files or is_file
+        if volume:
+            volumes.append(volume)
+        return volumes
+
+    @staticmethod
+    def _missing_parents(name: str, names: set[str]) -> list[tuple[Path, str]]:
+        return [
+            (Path("/", parent), str(parent))
+            for parent in reversed(Path(name).parents[:-1])
+            if str(parent) not in names
+        ]
+
+    # Returns the number of bytes a member takes up in an uncompressed
+    # archive: Its headers (in tar including the extended PAX headers for
+    # long names or fractional modification times) and its data (padded to
+    # full blocks in tar, or deflated in the worst case in zip).
+    def _member_size(
+        self, sizer: Optional[tarfile.TarFile], path: Path, name: str
+    ) -> int:
+        if sizer is None:
+            zip_info = ZipInfo.from_file(path, name)
+            size = zip_info.file_size
+            if size > 0:
+                size += (size >> 12) + (size >> 14) + (size >> 25) + 13
+            return (
+                self._zip_member_overhead
+                + 2 * len(zip_info.filename.encode("utf-8"))
+                + size
+            )
+        tar_info = sizer.gettarinfo(path, arcname="./" + name if name else ".")
+        header = tar_info.tobuf(sizer.format, sizer.encoding, sizer.errors)
+        blocks = -(-tar_info.size // tarfile.BLOCKSIZE) if tar_info.isreg() else 0
+        return len(header) + blocks * tarfile.BLOCKSIZE
+
+    # Returns the size of an uncompressed archive with members of the given
+    # size: A tar archive ends with two empty blocks and is padded to a
+    # multiple of the record size, a zip archive ends with its trailer.
+    def _archive_size(self, size: int) -> int:
+        if self._algorithm == Compression.Algorithm.ZIP:
+            return size + self._zip_trailer_size
+        records = -(-(size + 2 * tarfile.BLOCKSIZE) // tarfile.RECORDSIZE)
+        return records * tarfile.RECORDSIZE
+
+    # The files are written to the archive directly from their source, so
+    # every file is read once and no temporary space is needed.  The layout is
+    # the same as if the files were copied to an empty backup folder first and
+    # the archive was created from that folder: Every file is stored under its
+    # absolute path (relative to the root of the archive) and so are all the
+    # folders leading to it.
+    def _entries(self) -> Iterator[tuple[Path, str]]:
+        roots = sorted(
+            map(self._stat_cache.resolve, self._files), key=lambda path: path.parts
+        )
+        added: set[Path] = set()
+        for root in roots:
+            for parent in reversed(root.parents[:-1]):
+                if parent not in added:
+                    added.add(parent)
+                    yield parent, str(parent.relative_to("/"))
+            for path in Compression.walk(root):
+                yield path, str(path.relative_to("/"))
+
+    # Yields the given path and everything inside of it (following symlinks,
+    # like copying does) in depth first order with sorted folder entries.
+    @staticmethod
+    def walk(root: Path) -> Iterator[Path]:
+        folders: list[Path] = []
+        if root.is_dir():
+            folders.append(root)
+        yield root
+        while folders:
+            folder = folders.pop()
+            with os.scandir(folder) as it:
+                entries = sorted(it, key=lambda entry: entry.name)
+            for entry in entries:
+                path = Path(entry.path)
+                if entry.is_dir():
+                    folders.append(path)
+                    yield path
+                elif entry.is_file():
+                    yield path
+                else:
+                    logging.warning(
+                        f"Path '{path}' is neither a file nor a folder. Is ignored."
+                    )
+
+    # The block based writers are also used with a single thread in adaptive
+    # and in indexed mode, since they can store individual blocks without
+    # compression and record where every block starts.
+    def _compressor(self, raw: IO[bytes], threads: int) -> IO[bytes]:
+        block_based = threads > 1 or self._adaptive or self._indexed
+        if self._algorithm == Compression.Algorithm.GZTAR and block_based:
+            logging.debug(f"Compressing using {threads} threads")
+            return cast(
+                IO[bytes],
+                ParallelGzipFile(
+                    raw,
+                    threads=threads,
+                    level=self._level if self._level is not None else 9,
+                    adaptive=self._adaptive,
+                    independent=self._indexed,
+                ),
+            )
+        elif self._algorithm == Compression.Algorithm.GZTAR:
+            return cast(
+                IO[bytes],
+                gzip.GzipFile(
+                    fileobj=raw,
+                    mode="wb",
+                    compresslevel=self._level if self._level is not None else 9,
+                ),
+            )
+        elif self._algorithm == Compression.Algorithm.BZTAR:
+            if self._adaptive:
+                logging.warning("Adaptive compression is not supported for bztar")
+            if self._indexed:
+                logging.warning(
+                    "The index of a bztar archive can not point into the compressed "
+                    "data. Restoring reads the archive from the start."
+                )
+            return cast(
+                IO[bytes],
+                bz2.BZ2File(
+                    raw,
+                    "wb",
+                    compresslevel=self._level if self._level is not None else 9,
+                ),
+            )
+        elif self._algorithm == Compression.Algorithm.XZTAR and block_based:
+            logging.debug(f"Compressing using {threads} threads")
+            return cast(
+                IO[bytes],
+                ParallelXzFile(
+                    raw,
+                    threads=threads,
+                    preset=self._level if self._level is not None else 6,
+                    adaptive=self._adaptive,
+                ),
+            )
+        elif self._algorithm == Compression.Algorithm.XZTAR:
+            return cast(IO[bytes], lzma.LZMAFile(raw, "wb", preset=self._level))
+        else:
+            return raw
+
+    # Returns where the members have been placed in the archive.
+    def _write(
+        self, dest: Path, entries: Iterable[tuple[Path, str]], threads: int
+    ) -> ArchiveIndex.Volume:
+        logging.info(f"Creating archive '{dest}'")
+        if self._algorithm == Compression.Algorithm.ZIP:
+            return self._write_zip(dest, entries)
+        else:
+            return self._write_tar(dest, entries, threads)
+
+    def _write_tar(
+        self, dest: Path, entries: Iterable[tuple[Path, str]], threads: int
+    ) -> ArchiveIndex.Volume:
+        members: dict[str, int] = {}
+        with (
+            open(dest, "wb") as raw,
+            self._compressor(raw, threads) as stream,
+            tarfile.open(fileobj=stream, mode="w", dereference=True) as archive,
+        ):
+            archive.add("/", arcname=".", recursive=False)
+            for path, name in entries:
+                logging.debug(f"Adding '{path}'")
+                members[str(path)] = archive.offset
+                archive.add(path, arcname="./" + name, recursive=False)
+        blocks = stream.offsets if isinstance(stream, ParallelCompressedFile) else []
+        return ArchiveIndex.Volume(dest.name, members, blocks)
+
+    def _write_zip(
+        self, dest: Path, entries: Iterable[tuple[Path, str]]
+    ) -> ArchiveIndex.Volume:
+        members: dict[str, int] = {}
+        stored = 0
+        with ZipFile(
+            dest, "w", compression=ZIP_DEFLATED, compresslevel=self._level
+        ) as archive:
+            for path, name in entries:
+                logging.debug(f"Adding '{path}'")
+                compression = ZIP_DEFLATED
+                if (
+                    self._adaptive
+                    and path.is_file()
+                    and not Compressibility.is_compressible(path)
+                ):
+                    logging.debug(f"Storing '{path}' without compression")
+                    compression = ZIP_STORED
+                    stored += 1
+                archive.write(path, name, compress_type=compression)
+                members[str(path)] = archive.infolist()[-1].header_offset
+        if self._adaptive:
+            logging.info(f"Stored {stored} files without compression")
+        return ArchiveIndex.Volume(dest.name, members, [])
+
+
+class ArchiveRestorer:
+    # Members restored by a single task span at most this many bytes of the
+    # uncompressed archive, so large runs are spread over the worker threads.
+    _task_size = 64 << 20
+
+    # Restores files and folders from an archive created by Compression to
+    # their original location (or into the given target folder).  Using the
+    # index of the archive only the volumes and members which are restored
+    # are read: A run of consecutive members is read starting at the offset of
+    # its first member.  For archives compressed in blocks only the blocks
+    # from the one containing that offset on are decompressed.  The runs are
+    # restored by a pool of threads, each reading the archive on its own.
+    # Without index the whole archive is read by a single thread.
+    def __init__(
+        self,
+        archive: Path,
+        paths: list[Path],
+        *,
+        conflict_mode: CopyConflictMode,
+        target: Optional[Path] = None,
+        jobs: int = 1,
+    ) -> None:
+        if jobs < 1:
+            raise ValueError(f"The number of jobs must be positive, not {jobs}")
+        # An archive split into volumes only exists as its index (and the
+        # volumes).
+        index = ArchiveIndex.find(archive)
+        if index is None and not archive.exists():
+            raise FileNotFoundError(f"The archive '{archive}' does not exist.")
+        if target is not None and not target.is_dir():
+            raise NotADirectoryError(f"The path '{target}' does not refer to a folder.")
+
+        self._index = ArchiveIndex.load(index) if index is not None else None
+        self._archive = archive
+        self._paths = [str(path.absolute()) for path in paths]
+        self._root = target if target is not None else Path("/")
+        self._conflict_mode = conflict_mode
+        self._jobs = jobs
+        self._folders: list[tuple[Path, Optional[int], float]] = []
+        self._restored = 0
+        self._lock = Lock()
+
+    def restore(self, *, pretend: bool = False) -> None:
+        if self._index is None:
+            logging.warning(
+                f"No index found for '{self._archive}'. Reading the whole archive."
+            )
+            self._restore_unindexed(pretend)
+        else:
+            self._restore_indexed(self._index, pretend)
+
+        # Restoring the contents of a folder changes its modification time.
+        for folder, mode, mtime in self._folders:
+            if mode is not None:
+                os.chmod(folder, mode)
+            os.utime(folder, (mtime, mtime))
+        logging.info(f"Restored {self._restored} files")
+
+    def _selected(self, path: str) -> bool:
+        return Util.is_below(path, self._paths)
+
+    def _target(self, path: str) -> Path:
+        return self._root.joinpath(path.lstrip("/"))
+
+    def _restore_unindexed(self, pretend: bool) -> None:
+        if is_zipfile(self._archive):
+            with ZipFile(self._archive) as archive:
+                for info in archive.infolist():
+                    path = str(Path("/", info.filename))
+                    if not self._selected(path):
+                        continue
+                    elif info.is_dir() or self._overwrite(self._target(path)):
+                        self._restore_zip_member(archive, info, path, pretend)
+        else:
+            with tarfile.open(self._archive) as archive:
+                for member in archive:
+                    path = str(Path("/", member.name))
+                    if member.name == "." or not self._selected(path):
+                        continue
+                    elif member.isdir() or self._overwrite(self._target(path)):
+                        self._restore_tar_member(archive, member, path, pretend)
+
+    # Conflicts are resolved (including asking the user) before any member is
+    # restored, so the worker threads only read and write.
+    def _restore_indexed(self, index: ArchiveIndex, pretend: bool) -> None:
+        tasks: list[tuple[ArchiveIndex.Volume, list[str]]] = []
+        for volume in index.volumes:
+            selected = {
+                path
+                for path in volume.members
+                if self._selected(path) and self._overwrite(self._target(path))
+            }
+            if selected:
+                logging.info(f"Restoring {len(selected)} paths from '{volume.file}'")
+            tasks += [(volume, run) for run in self._runs(volume, selected)]
+
+        if pretend:
+            for _, run in tasks:
+                for path in run:
+                    logging.info(f"Restoring '{path}' to '{self._target(path)}'")
+            return
+
+        logging.debug(f"Restoring {len(tasks)} runs using {self._jobs} threads")
+        with ThreadPoolExecutor(max_workers=self._jobs) as executor:
+            futures = [
+                executor.submit(self._restore_run, index, volume, run)
+                for volume, run in tasks
+            ]
+            for future in futures:
+                future.result()
+
+    # Splits the selected members into runs of members which are stored next
+    # to each other (the members are listed in the order of the archive).
+    # Runs are split further, if they can be read starting at any member.
+    def _runs(self, volume: ArchiveIndex.Volume, selected: set[str]) -> list[list[str]]:
+        assert self._index is not None
+        seekable = (
+            bool(volume.blocks)
+            or self._index.algorithm == Compression.Algorithm.TAR.value
+        )
+        runs: list[list[str]] = []
+        run: list[str] = []
+        for member, offset in volume.members.items():
+            if run and (
+                member not in selected
+                or seekable
+                and offset - volume.members[run[0]] >= self._task_size
+            ):
+                runs.append(run)
+                run = []
+            if member in selected:
+                run.append(member)
+        if run:
+            runs.append(run)
+        return runs
+
+    def _restore_run(
+        self, index: ArchiveIndex, volume: ArchiveIndex.Volume, run: list[str]
+    ) -> None:
+        path = index.volume_path(volume)
+        if index.algorithm == Compression.Algorithm.ZIP.value:
+            with ZipFile(path) as archive:
+                for member in run:
+                    name = member.lstrip("/")
+                    try:
+                        info = archive.getinfo(name)
+                    except KeyError:
+                        info = archive.getinfo(name + "/")
+                    self._restore_zip_member(archive, info, member, pretend=False)
+            return
+
+        with (
+            open(path, "rb") as raw,
+            tarfile.open(
+                fileobj=self._open_at(raw, volume, volume.members[run[0]]), mode="r|"
+            ) as archive,
+        ):
+            for member in run:
+                tar_info = archive.next()
+                if tar_info is None:
+                    raise ValueError(f"Member '{member}' is missing in '{path}'")
+                self._restore_tar_member(archive, tar_info, member, pretend=False)
+
+    # Returns the uncompressed archive starting at the given offset.
+    def _open_at(
+        self, raw: IO[bytes], volume: ArchiveIndex.Volume, offset: int
+    ) -> IO[bytes]:
+        assert self._index is not None
+        algorithm = Compression.Algorithm(self._index.algorithm)
+        compressed_files: dict[Compression.Algorithm, type[ParallelCompressedFile]] = {
+            Compression.Algorithm.GZTAR: ParallelGzipFile,
+            Compression.Algorithm.XZTAR: ParallelXzFile,
+        }
+        if algorithm == Compression.Algorithm.TAR:
+            raw.seek(offset)
+            return raw
+        elif volume.blocks and algorithm in compressed_files:
+            reader = CompressedBlockReader(
+                raw, compressed_files[algorithm], volume.blocks, offset
+            )
+            return cast(IO[bytes], io.BufferedReader(reader))
+
+        logging.debug(f"Decompressing '{volume.file}' up to offset {offset}")
+        raw.seek(0)
+        stream: IO[bytes]
+        if algorithm == Compression.Algorithm.GZTAR:
+            stream = cast(IO[bytes], gzip.GzipFile(fileobj=raw, mode="rb"))
+        elif algorithm == Compression.Algorithm.BZTAR:
+            stream = cast(IO[bytes], bz2.BZ2File(raw, "rb"))
+        else:
+            stream = cast(IO[bytes], lzma.LZMAFile(raw, "rb"))
+        stream.seek(offset)
+        return stream
+
+    def _overwrite(self, target: Path) -> bool:
+        return Util.may_overwrite(target, self._conflict_mode)
+
+    def _restored_file(self, path: str, target: Path) -> None:
+        logging.info(f"Restoring '{path}' to '{target}'")
+        with self._lock:
+            self._restored += 1
+
+    # Parent folders are created up front, since tarfile cannot cope with
+    # another thread creating them at the same time.
+    def _restore_tar_member(
+        self,
+        archive: tarfile.TarFile,
+        member: tarfile.TarInfo,
+        path: str,
+        pretend: bool,
+    ) -> None:
+        target = self._target(path)
+        if member.isdir():
+            if not pretend:
+                target.mkdir(parents=True, exist_ok=True)
+                self._folders.append((target, member.mode, member.mtime))
+        else:
+            self._restored_file(path, target)
+            if not pretend:
+                target.parent.mkdir(parents=True, exist_ok=True)
+                archive.extract(member, self._root, filter="tar")
+
+    def _restore_zip_member(
+        self, archive: ZipFile, info: ZipInfo, path: str, pretend: bool
+    ) -> None:
+        target = self._target(path)
+        mode = info.external_attr >> 16 & 0o7777 or None
+        mtime = mktime(info.date_time + (0, 0, -1))
+        if info.is_dir():
+            if not pretend:
+                target.mkdir(parents=True, exist_ok=True)
+                self._folders.append((target, mode, mtime))
+        else:
+            self._restored_file(path, target)
+            if not pretend:
+                target.parent.mkdir(parents=True, exist_ok=True)
+                with archive.open(info) as src, open(target, "wb") as dst:
+                    copyfileobj(src, dst)
+                if mode is not None:
+                    os.chmod(target, mode)
+                os.utime(target, (mtime, mtime))
+
+
+class ChunkStore:
+    _chunk_size = 1 << 20
+    _version = 1
+
+    class Entry(NamedTuple):
+        path: str
+        mode: int
+        mtime_ns: int
+        size: int
+        inode: int
+        # The hashes of the chunks of a file, None for folders
+        chunks: Optional[list[str]]
+
+    # A backup folder which stores every file as a list of chunks of fixed
+    # size.  Every chunk is stored once under its SHA-256 hash in 'chunks',
+    # no matter how many files (or runs) contain it.  Every run writes a
+    # snapshot to 'snapshots' listing the files and folders with their
+    # metadata and chunks.  Files whose size, modification time and inode are
+    # the same as in the latest snapshot are not read again.
+    def __init__(
+        self,
+        dest: Path,
+        *,
+        stat_cache: Optional[StatCache] = None,
+        jobs: int = 1,
+    ) -> None:
+        if jobs < 1:
+            raise ValueError(f"The number of jobs must be positive, not {jobs}")
+        stat_cache = stat_cache if stat_cache is not None else StatCache()
+        if not stat_cache.exists(dest):
+            raise FileNotFoundError(
+                f"The destination directory '{dest}' does not exist"
+            )
+        if not stat_cache.is_dir(dest):
+            raise NotADirectoryError(
+                f"The destination path '{dest}' does not refer to a directory"
+            )
+        self._dest = stat_cache.resolve(dest)
+        self._chunks = self._dest.joinpath("chunks")
+        self._snapshots = self._dest.joinpath("snapshots")
+        self._stat_cache = stat_cache
+        self._jobs = jobs
+        self._known: set[str] = set()
+        self._lock = Lock()
+        self._new_chunks = 0
+        self._new_bytes = 0
+        self._read_files = 0
+
+    @staticmethod
+    def is_store(path: Path) -> bool:
+        return path.joinpath("snapshots").is_dir()
+
+    def snapshots(self) -> list[str]:
+        if not self._snapshots.is_dir():
+            return []
+        return sorted(path.stem for path in self._snapshots.glob("*.jsonl"))
+
+    def _chunk_path(self, digest: str) -> Path:
+        return self._chunks.joinpath(digest[:2], digest)
+
+    def _load(self, snapshot: str) -> list[Entry]:
+        path = self._snapshots.joinpath(snapshot + ".jsonl")
+        logging.info(f"Reading snapshot '{path}'")
+        with open(path) as lines:
+            header = json.loads(next(lines, "{}"))
+            if header.get("version") != self._version:
+                raise ValueError(f"Unknown version {header.get('version')}")
+            return [ChunkStore.Entry(**json.loads(line)) for line in lines]
+
+    def _save(self, entries: list[Entry]) -> None:
+        self._snapshots.mkdir(exist_ok=True)
+        name = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
+        path = self._snapshots.joinpath(name + ".jsonl")
+        i = 1
+        while path.exists():
+            path = self._snapshots.joinpath(f"{name}-{i}.jsonl")
+            i += 1
+        logging.info(f"Writing snapshot '{path}'")
+        tmp = path.with_name(path.name + ".tmp")
+        with open(tmp, "w") as f:
+            f.write(json.dumps({"version": self._version}) + "\n")
+            for entry in entries:
+                f.write(json.dumps(entry._asdict()) + "\n")
+        os.replace(tmp, path)
+
+    def backup(self, files: set[Path], *, pretend: bool = False) -> None:
+        logging.info(f"Backing up to chunk store '{self._dest}'")
+        previous: dict[str, ChunkStore.Entry] = {}
+        snapshots = self.snapshots()
+        if snapshots:
+            previous = {entry.path: entry for entry in self._load(snapshots[-1])}
+            for entry in previous.values():
+                self._known.update(entry.chunks or [])
+
+        entries: list[ChunkStore.Entry | Future[ChunkStore.Entry]] = []
+        with ThreadPoolExecutor(max_workers=self._jobs) as executor:
+            roots = sorted(
+                map(self._stat_cache.resolve, files), key=lambda path: path.parts
+            )
+            for path in (path for root in roots for path in Compression.walk(root)):
+                stat = path.stat()
+                unchanged = previous.get(str(path))
+                if S_ISDIR(stat.st_mode):
+                    entries.append(self._entry(path, stat, None))
+                elif unchanged is not None and (
+                    unchanged.size,
+                    unchanged.mtime_ns,
+                    unchanged.inode,
+                ) == (stat.st_size, stat.st_mtime_ns, stat.st_ino):
+                    entries.append(unchanged._replace(mode=stat.st_mode))
+                else:
+                    logging.info(f"Storing '{path}'")
+                    if not pretend:
+                        entries.append(executor.submit(self._store, path))
+            snapshot = [
+                entry.result() if isinstance(entry, Future) else entry
+                for entry in entries
+            ]
+
+        if not pretend:
+            self._save(snapshot)
+        logging.info(
+            f"Read {self._read_files} files and stored {self._new_chunks} new "
+            f"chunks ({Util.format_size(self._new_bytes)})"
+        )
+
+    def _entry(
+        self, path: Path, stat: os.stat_result, chunks: Optional[list[str]]
+    ) -> Entry:
+        return ChunkStore.Entry(
+            str(path),
+            stat.st_mode,
+            stat.st_mtime_ns,
+            stat.st_size,
+            stat.st_ino,
+            chunks,
+        )
+
+    # Called by the worker threads.  The metadata is taken from the open
+    # file, so it matches the contents which have been read.
+    def _store(self, path: Path) -> Entry:
+        chunks: list[str] = []
+        with open(path, "rb") as f:
+            stat = os.fstat(f.fileno())
+            while chunk := f.read(self._chunk_size):
+                digest = hashlib.sha256(chunk).hexdigest()
+                chunks.append(digest)
+                self._write_chunk(digest, chunk)
+        with self._lock:
+            self._read_files += 1
+        return self._entry(path, stat, chunks)
+
+    # A chunk is written to a temporary file first, so a chunk file is either
+    # complete or missing, even if the backup is interrupted.
+    def _write_chunk(self, digest: str, chunk: bytes) -> None:
+        with self._lock:
+            if digest in self._known:
+                return
+            self._known.add(digest)
+        path = self._chunk_path(digest)
+        if path.exists():
+            return
+
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_name(path.name + ".tmp")
+        with open(tmp, "wb") as f:
+            f.write(chunk)
+        os.replace(tmp, path)
+        with self._lock:
+            self._new_chunks += 1
+            self._new_bytes += len(chunk)
+
+    # Restores files and folders from a snapshot (by default the latest) to
+    # their original location (or into the given target folder).
+    def restore(
+        self,
+        paths: list[Path],
+        *,
+        target: Optional[Path] = None,
+        snapshot: Optional[str] = None,
+        conflict_mode: CopyConflictMode = CopyConflictMode.NO_OVERWRITE,
+        pretend: bool = False,
+    ) -> None:
+        snapshots = self.snapshots()
+        if snapshot is None and snapshots:
+            snapshot = snapshots[-1]
+        if snapshot not in snapshots:
+            raise FileNotFoundError(f"The snapshot '{snapshot}' does not exist.")
+        if target is not None and not target.is_dir():
+            raise NotADirectoryError(f"The path '{target}' does not refer to a folder.")
+
+        root = target if target is not None else Path("/")
+        selected = [str(path.absolute()) for path in paths]
+        folders: list[tuple[Path, ChunkStore.Entry]] = []
+        with ThreadPoolExecutor(max_workers=self._jobs) as executor:
+            futures: list[Future[None]] = []
+            for entry in self._load(snapshot):
+                destination = root.joinpath(entry.path.lstrip("/"))
+                if not Util.is_below(entry.path, selected):
+                    continue
+                elif entry.chunks is None:
+                    if not pretend:
+                        destination.mkdir(parents=True, exist_ok=True)
+                        folders.append((destination, entry))
+                elif Util.may_overwrite(destination, conflict_mode):
+                    logging.info(f"Restoring '{entry.path}' to '{destination}'")
+                    if not pretend:
+                        destination.parent.mkdir(parents=True, exist_ok=True)
+                        futures.append(
+                            executor.submit(self._restore_file, entry, destination)
+                        )
+            for future in futures:
+                future.result()
+
+        for folder, entry in folders:
+            os.chmod(folder, entry.mode & 0o7777)
+            os.utime(folder, ns=(entry.mtime_ns, entry.mtime_ns))
+
+    def _restore_file(self, entry: Entry, destination: Path) -> None:
+        assert entry.chunks is not None
+        with open(destination, "wb") as f:
+            for digest in entry.chunks:
+                with open(self._chunk_path(digest), "rb") as chunk:
+                    copyfileobj(chunk, f)
+        os.chmod(destination, entry.mode & 0o7777)
+        os.utime(destination, ns=(entry.mtime_ns, entry.mtime_ns))
+
+
+class CompressionTuner:
+    _sample_size = 8 << 20
+    _max_bytes_per_file = 1 << 20
+    _levels = {
+        Compression.Algorithm.TAR: [0],
+        Compression.Algorithm.ZIP: [1, 6, 9],
+        Compression.Algorithm.GZTAR: [1, 6, 9],
+        Compression.Algorithm.BZTAR: [1, 9],
+        Compression.Algorithm.XZTAR: [0, 3, 6, 9],
+    }
+    # Algorithms which compress on several threads if asked to.
+    _parallel = {Compression.Algorithm.GZTAR, Compression.Algorithm.XZTAR}
+
+    class Result(NamedTuple):
+        algorithm: Compression.Algorithm
+        level: int
+        throughput: float
+        ratio: float
+
+    # Picks an algorithm and compression level for the files to back up by
+    # compressing a sample of them with every candidate.  The sample consists
+    # of the beginnings of files spread evenly over all files.  The results
+    # and the chosen candidate are printed unless quiet.
+    def __init__(
+        self,
+        files: set[Path],
+        *,
+        stat_cache: Optional[StatCache] = None,
+        threads: int = 1,
+        quiet: bool = False,
+    ) -> None:
+        self._files = files
+        self._quiet = quiet
+        self._stat_cache = stat_cache if stat_cache is not None else StatCache()
+        self._threads = threads
+
+    def _sample(self) -> bytes:
+        roots = sorted(map(self._stat_cache.resolve, self._files))
+        paths = [
+            path for root in roots for path in Compression.walk(root) if path.is_file()
+        ]
+        count = min(len(paths), self._sample_size // self._max_bytes_per_file)
+        step = len(paths) / count if count > 0 else 1
+        sample = bytearray()
+        for i in range(count):
+            with open(paths[int(i * step)], "rb") as f:
+                sample += f.read(self._max_bytes_per_file)
+        return bytes(sample)
+
+    def _measure(
+        self, algorithm: Compression.Algorithm, level: int, sample: bytes
+    ) -> Result:
+        compress: dict[Compression.Algorithm, Callable[[bytes], bytes]] = {
+            Compression.Algorithm.TAR: lambda data: bytes(data),
+            Compression.Algorithm.ZIP: lambda data: zlib.compress(data, level),
+            Compression.Algorithm.GZTAR: lambda data: zlib.compress(data, level),
+            Compression.Algorithm.BZTAR: lambda data: bz2.compress(data, level),
+            Compression.Algorithm.XZTAR: lambda data: lzma.compress(data, preset=level),
+        }
+        start = perf_counter()
+        size = len(compress[algorithm](sample))
+        seconds = perf_counter() - start
+        if algorithm in self._parallel:
+            seconds /= self._threads
+        throughput = len(sample) / max(seconds, 1e-9)
+        return CompressionTuner.Result(
+            algorithm, level, throughput, size / max(len(sample), 1)
+        )
+
+    # With a throughput target the candidate with the best ratio which is fast
+    # enough is picked.  With a ratio target the fastest candidate which
+    # compresses well enough is picked.  If no candidate meets the target, the
+    # one closest to it is picked.
+    def tune(
+        self,
+        algorithms: list[Compression.Algorithm],
+        *,
+        target_throughput: Optional[float] = None,
+        target_ratio: Optional[float] = None,
+    ) -> Result:
+        logging.info("Benchmarking compression algorithms")
+        sample = self._sample()
+        logging.debug(f"Sample size: {Util.format_size(len(sample))}")
+        results = [
+            self._measure(algorithm, level, sample)
+            for algorithm in algorithms
+            for level in self._levels[algorithm]
+        ]
+        for result in results:
+            if result.algorithm == Compression.Algorithm.TAR:
+                self._print(
+                    f"{result.algorithm.value:>6} (uncompressed): "
+                    f"{Util.format_size(result.throughput)}/s"
+                )
+            else:
+                self._print(
+                    f"{result.algorithm.value:>6} level {result.level}: "
+                    f"{Util.format_size(result.throughput)}/s, "
+                    f"ratio {result.ratio:.3f}"
+                )
+
+        if target_throughput is not None:
+            candidates = [r for r in results if r.throughput >= target_throughput]
+            best = (
+                min(candidates, key=lambda r: r.ratio)
+                if candidates
+                else max(results, key=lambda r: r.throughput)
+            )
+        else:
+            # Not compressing at all never meets a ratio target.
+            compressed = [
+                r for r in results if r.algorithm != Compression.Algorithm.TAR
+            ] or results
+            limit = target_ratio if target_ratio is not None else 1.0
+            candidates = [r for r in compressed if r.ratio <= limit]
+            best = (
+                max(candidates, key=lambda r: r.throughput)
+                if candidates
+                else min(compressed, key=lambda r: r.ratio)
+            )
+        if not candidates:
+            logging.warning("No compression algorithm meets the target")
+        self._print(f"Using {best.algorithm.value} with level {best.level}")
+        return best
+
+    def _print(self, message: str) -> None:
+        if not self._quiet:
+            print(message)
 
 
 class Main:
@@ -457,6 +3195,211 @@ class Main:
             help="Show output without actually copying anything",
         )
 
+        parser.add_argument(
+            "--compress-threads",
+            type=int,
+            default=1,
+            help="Number of threads used to compress an archive",
+        )
+
+        parser.add_argument(
+            "--volume-size",
+            type=Util.parse_size,
+            metavar="SIZE",
+            help="Split the archive into volumes of at most SIZE bytes each "
+            "(e.g. 4G or 700M)",
+        )
+
+        parser.add_argument(
+            "--compress-auto",
+            action="store_true",
+            help="Choose the compression algorithm (unless given by --compress) "
+            "and level by benchmarking a sample of the files",
+        )
+
+        auto_target = parser.add_mutually_exclusive_group()
+        auto_target.add_argument(
+            "--target-throughput",
+            type=float,
+            metavar="MIB_PER_SECOND",
+            help="Use the best compression which is at least this fast",
+        )
+        auto_target.add_argument(
+            "--target-ratio",
+            type=float,
+            help="Use the fastest compression reaching this ratio of compressed "
+            "to original size",
+        )
+
+        parser.add_argument(
+            "--adaptive-compression",
+            action="store_true",
+            help="Store files (or blocks) which do not compress well without compression",
+        )
+
+        parser.add_argument(
+            "-j",
+            "--jobs",
+            type=int,
+            default=1,
+            help="Number of files to copy concurrently",
+        )
+
+        parser.add_argument(
+            "--compare",
+            type=str,
+            choices=ComparisonMode.values(),
+            default=ComparisonMode.SHALLOW.value,
+            help="How to decide if an existing file in the backup folder is up to date",
+        )
+
+        parser.add_argument(
+            "--incremental",
+            action="store_true",
+            help="Only look at files which changed since the last backup",
+        )
+
+        parser.add_argument(
+            "--reflink",
+            type=str,
+            choices=ReflinkMode.values(),
+            default=ReflinkMode.AUTO.value,
+            help="Clone files on copy-on-write file systems instead of copying them",
+        )
+
+        parser.add_argument(
+            "--delta-threshold",
+            type=Util.parse_size,
+            metavar="SIZE",
+            help="Only rewrite the changed blocks of existing files in the backup "
+            "folder which are at least SIZE bytes large",
+        )
+
+        parser.add_argument(
+            "--schedule",
+            type=str,
+            choices=SchedulePolicy.values(),
+            default=SchedulePolicy.BATCHED.value,
+            help="Order in which files are copied concurrently",
+        )
+
+        parser.add_argument(
+            "--disk-order",
+            type=str,
+            choices=TraversalOrder.values(),
+            default=TraversalOrder.DIRECTORY.value,
+            help="Order in which the entries of source folders are read",
+        )
+
+        parser.add_argument(
+            "--cache",
+            type=str,
+            choices=CachePolicy.values(),
+            default=CachePolicy.KEEP.value,
+            help="Keep copied files in the page cache or drop them after copying",
+        )
+
+        parser.add_argument(
+            "--direct-threshold",
+            type=Util.parse_size,
+            metavar="SIZE",
+            help="Copy files of at least SIZE bytes bypassing the page cache "
+            "(O_DIRECT)",
+        )
+
+        parser.add_argument(
+            "--split-threshold",
+            type=Util.parse_size,
+            metavar="SIZE",
+            help="Copy files of at least SIZE bytes in ranges using the number "
+            "of threads given by --jobs",
+        )
+
+        parser.add_argument(
+            "--snapshots",
+            action="store_true",
+            help="Create a new snapshot folder in every run, hard linking "
+            "unchanged files to the previous snapshot",
+        )
+
+        parser.add_argument(
+            "--keep",
+            type=int,
+            metavar="N",
+            help="Only keep the latest N snapshots",
+        )
+
+        parser.add_argument(
+            "--store",
+            action="store_true",
+            help="Store each unique chunk of the files only once and write a "
+            "snapshot of the files in every run",
+        )
+
+        parser.add_argument(
+            "--index",
+            action="store_true",
+            help="Write an index next to the archive, which allows to restore "
+            "single files quickly",
+        )
+
+        Main._add_common_arguments(parser)
+        return parser
+
+    @staticmethod
+    def _create_restore_parser() -> ArgumentParser:
+        parser = ArgumentParser(
+            prog="sbu.py restore",
+            description="Restore files from a backup to their original location",
+        )
+        parser.add_argument(
+            "backup",
+            help="Path to the backup folder or to the archive (or its index) "
+            "created by the --compress option.",
+            type=Path,
+        )
+        parser.add_argument(
+            "paths",
+            nargs="+",
+            help="Original paths of the files or folders which should be restored.",
+            type=Path,
+        )
+        parser.add_argument(
+            "--to",
+            type=Path,
+            metavar="FOLDER",
+            help="Restore into FOLDER instead of the original location",
+        )
+        parser.add_argument(
+            "--snapshot",
+            metavar="NAME",
+            help="Snapshot of a chunk store to restore from (default: the latest)",
+        )
+        parser.add_argument(
+            "-p",
+            "--pretend",
+            action="store_true",
+            help="Show output without actually restoring anything",
+        )
+        parser.add_argument(
+            "-j",
+            "--jobs",
+            type=int,
+            default=1,
+            help="Number of files (or parts of an archive) to restore concurrently",
+        )
+        parser.add_argument(
+            "--reflink",
+            type=str,
+            choices=ReflinkMode.values(),
+            default=ReflinkMode.AUTO.value,
+            help="Clone files on copy-on-write file systems instead of copying them",
+        )
+        Main._add_common_arguments(parser)
+        return parser
+
+    @staticmethod
+    def _add_common_arguments(parser: ArgumentParser) -> None:
         conflicts = parser.add_mutually_exclusive_group()
         conflicts.add_argument(
             "-f", "--force", action="store_true", help="Overwrite existing files"
@@ -478,10 +3421,10 @@ class Main:
         verbosity.add_argument(
             "-d", "--debug", action="store_true", help="Show debug output"
         )
-        return parser
 
     def __init__(self) -> None:
         self._parser = Main._create_parser()
+        self._restore_parser = Main._create_restore_parser()
 
     def _configure_logging(self, args: Namespace) -> None:
         format = "%(levelname)-8s - %(message)s"
@@ -494,9 +3437,161 @@ class Main:
         else:
             logging.basicConfig(level=logging.WARNING, format=format)
 
+    @staticmethod
+    def _conflict_mode(args: Namespace) -> CopyConflictMode:
+        if args.force:
+            return CopyConflictMode.OVERWRITE
+        elif args.interactive:
+            return CopyConflictMode.ASK
+        return CopyConflictMode.NO_OVERWRITE
+
+    # Returns the options which are given with a value other than their
+    # default.
+    def _given_options(self, args: Namespace, options: list[str]) -> list[str]:
+        return [
+            option
+            for option in options
+            if getattr(args, option[2:].replace("-", "_"))
+            != self._parser.get_default(option[2:].replace("-", "_"))
+        ]
+
+    def _check_args(self, args: Namespace) -> None:
+        if args.jobs < 1:
+            self._parser.error("argument -j/--jobs: must be at least 1")
+        if args.split_threshold is not None and args.jobs < 2:
+            self._parser.error(
+                "argument --split-threshold: requires -j/--jobs of 2 or more"
+            )
+        if (
+            args.disk_order != TraversalOrder.DIRECTORY.value
+            and args.jobs > 1
+            and args.schedule == SchedulePolicy.LARGEST_FIRST.value
+        ):
+            logging.warning(
+                "Option --disk-order has no effect with --schedule largest-first. "
+                "Is ignored."
+            )
+        if args.direct_threshold is not None and args.cache != CachePolicy.DROP.value:
+            self._parser.error("argument --direct-threshold: requires --cache drop")
+        if args.compress_threads < 1:
+            self._parser.error("argument --compress-threads: must be at least 1")
+        if args.compress_auto and (
+            args.target_throughput is None and args.target_ratio is None
+        ):
+            self._parser.error(
+                "argument --compress-auto: requires --target-throughput or "
+                "--target-ratio"
+            )
+        if not args.compress_auto:
+            for option, value in (
+                ("--target-throughput", args.target_throughput),
+                ("--target-ratio", args.target_ratio),
+            ):
+                if value is not None:
+                    logging.warning(
+                        f"Option {option} requires --compress-auto. Is ignored."
+                    )
+            args.target_throughput = args.target_ratio = None
+        if args.volume_size is not None and args.volume_size < 2**20:
+            self._parser.error("argument --volume-size: must be at least 1M")
+        if args.volume_size is not None and not (args.compress or args.compress_auto):
+            self._parser.error("argument --volume-size: requires -c/--compress")
+        if args.index and not (args.compress or args.compress_auto):
+            self._parser.error("argument --index: requires -c/--compress")
+        if args.store and (args.compress or args.compress_auto):
+            self._parser.error("argument --store: not allowed with -c/--compress")
+        if args.store:
+            # Options of copying files which the chunk store does not use.
+            given = self._given_options(
+                args,
+                [
+                    "--incremental",
+                    "--delta-threshold",
+                    "--compare",
+                    "--reflink",
+                    "--split-threshold",
+                    "--schedule",
+                    "--disk-order",
+                    "--cache",
+                    "--direct-threshold",
+                ],
+            )
+            if given:
+                self._parser.error(
+                    f"argument --store: not allowed with {', '.join(given)}"
+                )
+        if args.snapshots and (
+            args.compress
+            or args.compress_auto
+            or args.store
+            or args.incremental
+            or args.delta_threshold is not None
+        ):
+            self._parser.error(
+                "argument --snapshots: not allowed with -c/--compress, --store, "
+                "--incremental or --delta-threshold"
+            )
+        if args.keep is not None and (not args.snapshots or args.keep < 1):
+            self._parser.error(
+                "argument --keep: requires --snapshots and must be at least 1"
+            )
+
+    def _compress(
+        self,
+        args: Namespace,
+        files: set[Path],
+        conflict_mode: CopyConflictMode,
+        stat_cache: StatCache,
+    ) -> None:
+        algorithm = Compression.Algorithm(args.compress or "gztar")
+        level: Optional[int] = None
+        if args.compress_auto:
+            tuner = CompressionTuner(
+                files,
+                stat_cache=stat_cache,
+                threads=args.compress_threads,
+                quiet=args.quite,
+            )
+            result = tuner.tune(
+                [algorithm] if args.compress else list(Compression.Algorithm),
+                target_throughput=(
+                    args.target_throughput * 2**20
+                    if args.target_throughput is not None
+                    else None
+                ),
+                target_ratio=args.target_ratio,
+            )
+            algorithm, level = result.algorithm, result.level
+
+        try:
+            compression = Compression(
+                args.backup_destination,
+                files,
+                algorithm,
+                conflict_mode=conflict_mode,
+                stat_cache=stat_cache,
+                threads=args.compress_threads,
+                adaptive=args.adaptive_compression,
+                level=level,
+                volume_size=args.volume_size,
+                indexed=args.index,
+            )
+        except FileNotFoundError as e:
+            logging.error(e)
+            exit(errno.ENOENT)
+        except NotADirectoryError as e:
+            logging.error(e)
+            exit(errno.ENOTDIR)
+        except NoDefaultFilenameAvailableError as e:
+            logging.error(e)
+            exit(errno.ENOENT)
+
+        compression.compress_files(pretend=args.pretend)
+
     def main(self) -> None:
         args: Namespace = self._parser.parse_args()
         self._configure_logging(args)
+        self._check_args(args)
         try:
             reader = BackupFileParser(args.backup_file_path)
         except FileNotFoundError as e:
@@ -504,11 +3599,13 @@ class Main:
             exit(errno.ENOENT)
 
         files = reader.get_paths()
+        stat_cache = StatCache()
         try:
             dest = args.backup_destination
-            if args.compress and not dest.is_dir():
+            compress = args.compress is not None or args.compress_auto
+            if compress and not stat_cache.is_dir(dest):
                 dest = dest.parent
-            filterer = Filterer(dest, files)
+            filterer = Filterer(dest, files, stat_cache=stat_cache)
         except FileNotFoundError as e:
             logging.error(e)
             exit(errno.ENOENT)
@@ -517,24 +3614,16 @@ class Main:
             exit(errno.ENOTDIR)
 
         filtered_files = filterer.filter()
-        optimizer = Optimizer(filtered_files)
+        optimizer = Optimizer(filtered_files, stat_cache=stat_cache)
         optimized_files = optimizer.optimize()
 
-        conflict_mode = CopyConflictMode.NO_OVERWRITE
-        if args.force:
-            conflict_mode = CopyConflictMode.OVERWRITE
-        elif args.interactive:
-            conflict_mode = CopyConflictMode.ASK
-
-        if args.compress is not None:
-            algorithm = Compression.Algorithm(args.compress)
-
+        conflict_mode = self._conflict_mode(args)
+        if args.compress is not None or args.compress_auto:
+            self._compress(args, optimized_files, conflict_mode, stat_cache)
+        elif args.store:
             try:
-                compression = Compression(
-                    args.backup_destination,
-                    optimized_files,
-                    algorithm,
-                    conflict_mode=conflict_mode,
+                store = ChunkStore(
+                    args.backup_destination, stat_cache=stat_cache, jobs=args.jobs
                 )
             except FileNotFoundError as e:
                 logging.error(e)
@@ -542,31 +3631,108 @@ class Main:
             except NotADirectoryError as e:
                 logging.error(e)
                 exit(errno.ENOTDIR)
-            except NoDefaultFilenameAvailableError as e:
-                logging.error(e)
-                exit(errno.ENOENT)
 
-            compression.compress_files(pretend=args.pretend)
+            store.backup(optimized_files, pretend=args.pretend)
         else:
             try:
-                copyer = CopyFiles(
-                    args.backup_destination,
-                    optimized_files,
-                    conflict_mode=conflict_mode,
-                )
+                copyer: CopyFiles
+                if args.snapshots:
+                    copyer = SnapshotFiles(
+                        args.backup_destination,
+                        optimized_files,
+                        conflict_mode=conflict_mode,
+                        stat_cache=stat_cache,
+                        jobs=args.jobs,
+                        reflink=ReflinkMode(args.reflink),
+                        comparison=ComparisonMode(args.compare),
+                        keep=args.keep,
+                        split_threshold=args.split_threshold,
+                        schedule=SchedulePolicy(args.schedule),
+                        order=TraversalOrder(args.disk_order),
+                        cache=CachePolicy(args.cache),
+                        direct_threshold=args.direct_threshold,
+                    )
+                else:
+                    copyer = CopyFiles(
+                        args.backup_destination,
+                        optimized_files,
+                        conflict_mode=conflict_mode,
+                        stat_cache=stat_cache,
+                        jobs=args.jobs,
+                        reflink=ReflinkMode(args.reflink),
+                        comparison=ComparisonMode(args.compare),
+                        incremental=args.incremental,
+                        delta_threshold=args.delta_threshold,
+                        split_threshold=args.split_threshold,
+                        schedule=SchedulePolicy(args.schedule),
+                        order=TraversalOrder(args.disk_order),
+                        cache=CachePolicy(args.cache),
+                        direct_threshold=args.direct_threshold,
+                    )
             except FileNotFoundError as e:
                 logging.error(e)
                 exit(errno.ENOENT)
             except NotADirectoryError as e:
                 logging.error(e)
                 exit(errno.ENOTDIR)
+            except FileExistsError as e:
+                logging.error(e)
+                exit(errno.EEXIST)
 
             copyer.copy(pretend=args.pretend)
 
+        stat_cache.log_statistics()
+
+    def restore(self, argv: Optional[list[str]] = None) -> None:
+        args: Namespace = self._restore_parser.parse_args(argv)
+        if args.jobs < 1:
+            self._restore_parser.error("argument -j/--jobs: must be at least 1")
+        self._configure_logging(args)
+        stat_cache = StatCache()
+        try:
+            if ChunkStore.is_store(args.backup):
+                ChunkStore(args.backup, stat_cache=stat_cache, jobs=args.jobs).restore(
+                    args.paths,
+                    target=args.to,
+                    snapshot=args.snapshot,
+                    conflict_mode=self._conflict_mode(args),
+                    pretend=args.pretend,
+                )
+            elif stat_cache.is_dir(args.backup):
+                RestoreFiles(
+                    args.backup,
+                    args.paths,
+                    target=args.to,
+                    conflict_mode=self._conflict_mode(args),
+                    stat_cache=stat_cache,
+                    jobs=args.jobs,
+                    reflink=ReflinkMode(args.reflink),
+                ).copy(pretend=args.pretend)
+            else:
+                ArchiveRestorer(
+                    args.backup,
+                    args.paths,
+                    conflict_mode=self._conflict_mode(args),
+                    target=args.to,
+                    jobs=args.jobs,
+                ).restore(pretend=args.pretend)
+        except FileNotFoundError as e:
+            logging.error(e)
+            exit(errno.ENOENT)
+        except NotADirectoryError as e:
+            logging.error(e)
+            exit(errno.ENOTDIR)
+        except (ValueError, tarfile.TarError) as e:
+            logging.error(e)
+            exit(errno.EINVAL)
+
 
 if __name__ == "__main__":
     if platform != "linux":
         print("For now, the only supported platform is Linux")
         exit(errno.ENOSYS)
     main = Main()
-    main.main()
+    if argv[1:2] == ["restore"]:
+        main.restore(argv[2:])
+    else:
+        main.main()
@@ -0,0 +1,67 @@
+import os
+import tarfile
+import unittest
+from pathlib import Path
+from tempfile import TemporaryDirectory
+
+from sbu import Compression
+
+
+class VolumeSizeTest(unittest.TestCase):
+    volume_size = 1 << 20
+
+    # Fractional modification times and long names make tarfile write
+    # extended PAX headers, which have to fit into the volume size as well.
+    def test_tar_volumes_fit_volume_size(self) -> None:
+        with TemporaryDirectory() as tmp:
+            src = Path(tmp, "src")
+            src.joinpath("sub").mkdir(parents=True)
+            for i in range(300):
+                folder = src.joinpath("sub") if i % 3 == 0 else src
+                path = folder.joinpath("x" * (5, 120, 180)[i % 3] + str(i))
+                path.write_bytes(os.urandom(i * 131 % 40000))
+                os.utime(path, (1.5e9 + 0.25, 1.5e9 + 0.25))
+            dest = Path(tmp, "dest")
+            dest.mkdir()
+
+            Compression(
+                dest.joinpath("v.tar"),
+                {src},
+                Compression.Algorithm.TAR,
+                volume_size=self.volume_size,
+            ).compress_files()
+
+            volumes = sorted(dest.glob("v.vol*.tar"))
+            self.assertGreater(len(volumes), 1)
+            names: set[str] = set()
+            for volume in volumes:
+                self.assertLessEqual(volume.stat().st_size, self.volume_size)
+                with tarfile.open(volume) as archive:
+                    names.update(archive.getnames())
+            self.assertEqual(300, len({name for name in names if "/x" in name}))
+
+    # A file larger than the volume size gets a volume of its own, but the
+    # folders leading to it must not be left in a volume without files.
+    def test_no_volume_of_folders_only(self) -> None:
+        with TemporaryDirectory() as tmp:
+            src = Path(tmp, "src")
+            src.mkdir()
+            src.joinpath("big").write_bytes(os.urandom(2 * self.volume_size))
+            src.joinpath("small").write_bytes(os.urandom(1000))
+            dest = Path(tmp, "dest")
+            dest.mkdir()
+
+            Compression(
+                dest.joinpath("v.tar"),
+                {src},
+                Compression.Algorithm.TAR,
+                volume_size=self.volume_size,
+            ).compress_files()
+
+            for volume in sorted(dest.glob("v.vol*.tar")):
+                with tarfile.open(volume) as archive:
+                    self.assertTrue(any(m.isfile() for m in archive.getmembers()))
+
+
+if __name__ == "__main__":
+    unittest.main()